@@ -1,36 +1,101 @@
-from flask import Flask, request, render_template, url_for, redirect, flash
+from flask import Flask, request, render_template, url_for, redirect, flash, g, jsonify, Response, \
+    stream_with_context, abort, has_request_context, session, make_response
+from markupsafe import Markup
 from flask_admin.contrib import sqla
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import create_engine
+from sqlalchemy import event, update, bindparam
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateIndex, DDL
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from bisect import bisect_left
+from functools import wraps
+import click
+import csv
+import hashlib
+import hmac
+import io
+import json
 import os.path
+import random
+import re
+import secrets
+import sqlite3
+import subprocess
+import threading
+import time
 from flask_admin import Admin, expose, AdminIndexView
 from flask_login import LoginManager, UserMixin, current_user, login_user, login_required, logout_user
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///' + os.path.join(basedir, 'app.sqlite')
+
+# storage settings, each one can be overridden with an environment variable of the same name
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    'SQLALCHEMY_DATABASE_URI', 'sqlite:///' + os.path.join(basedir, 'app.sqlite'))
+app.config['SQLALCHEMY_ECHO'] = os.environ.get('SQLALCHEMY_ECHO', '0') == '1'
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # milliseconds
+app.config['SQLITE_CACHE_SIZE'] = int(os.environ.get('SQLITE_CACHE_SIZE', -16000))  # negative values are KiB
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': QueuePool,
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    # a ping on every checkout only pays off for network databases, a local SQLite file does not go stale
+    'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '0') == '1',
+    # pooled connections are handed between request threads
+    'connect_args': {'check_same_thread': False},
+}
 
 db = SQLAlchemy(app)
-engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+
+
+# apply the SQLite pragmas to every new pooled connection, WAL lets readers keep going while a write commits
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={app.config['SQLITE_JOURNAL_MODE']}")
+    cursor.execute(f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT']:d}")
+    cursor.execute(f"PRAGMA cache_size={app.config['SQLITE_CACHE_SIZE']:d}")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
 
 app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
-app.secret_key = 'keep secret'  # placeholder
+# every worker has to share the same key for sessions to survive across processes
+app.secret_key = os.environ.get('SECRET_KEY', 'keep secret')  # placeholder
 
 
+# loads the user together with its Teacher/Student profile, so the role is known without another query
 @login_manager.user_loader
 def load_user(user_id):
-    return Users.query.get(user_id)
+    row = db.session.query(Users, Teachers, Students).\
+        outerjoin(Teachers, Teachers.user_id == Users.id).outerjoin(Students, Students.user_id == Users.id).\
+        filter(Users.id == int(user_id)).first()
+    if row is None:
+        return None
+    user, teacher, student = row
+    g.setdefault('profiles', {})[user.id] = (teacher, student)
+    return user
 
 
 # restrict admin page from being accessed by students
 class AdminIndex(AdminIndexView):
     @expose('/')
     def index(self):
-        if not is_teacher(current_user) and not current_user.is_authenticated:
+        if not current_user.is_authenticated or not is_teacher(current_user):
             return redirect(url_for('login'))
         return super(AdminIndex, self).index()
 
@@ -47,69 +112,402 @@ class AdminMixin:
         return redirect(url_for('login', next=request.url))
 
 
+# password hashing, the cost settings should be tuned with `flask calibrate-password-hash` so a login stays
+# within PASSWORD_HASH_TARGET_MS on the production host
+PASSWORD_HASHERS = ('pbkdf2_sha256', 'scrypt')
+app.config['PASSWORD_HASHER'] = os.environ.get('PASSWORD_HASHER', 'pbkdf2_sha256')
+app.config['PASSWORD_PBKDF2_ITERATIONS'] = int(os.environ.get('PASSWORD_PBKDF2_ITERATIONS', 260000))
+app.config['PASSWORD_SCRYPT_N'] = int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14))
+app.config['PASSWORD_HASH_TARGET_MS'] = int(os.environ.get('PASSWORD_HASH_TARGET_MS', 100))
+
+
+def password_cost(hasher):
+    return app.config['PASSWORD_SCRYPT_N'] if hasher == 'scrypt' else app.config['PASSWORD_PBKDF2_ITERATIONS']
+
+
+def derive_key(hasher, cost, password, salt):
+    if hasher == 'scrypt':
+        return hashlib.scrypt(password.encode(), salt=salt.encode(), n=cost, r=8, p=1, maxmem=256 * 8 * cost, dklen=32)
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), cost)
+
+
+# stored as hasher$cost$salt$hex digest
+def hash_password(password, hasher=None, cost=None):
+    hasher = hasher or app.config['PASSWORD_HASHER']
+    cost = cost or password_cost(hasher)
+    salt = secrets.token_hex(16)
+    return f'{hasher}${cost}${salt}${derive_key(hasher, cost, password, salt).hex()}'
+
+
+def is_password_hash(value):
+    return value.split('$', 1)[0] in PASSWORD_HASHERS and value.count('$') == 3
+
+
+# anything that is not in the hash format is a legacy plaintext password. A malformed hash (a cost that is not
+# a number or that the hasher rejects) never matches
+def verify_password(stored, password):
+    if not is_password_hash(stored):
+        return hmac.compare_digest(stored.encode(), password.encode())
+    hasher, cost, salt, digest = stored.split('$')
+    try:
+        return hmac.compare_digest(derive_key(hasher, int(cost), password, salt).hex(), digest)
+    except (ValueError, TypeError):
+        return False
+
+
+# hashes of a random password per (hasher, cost), made on first use
+DUMMY_PASSWORD_HASHES = {}
+
+
+# checked instead when a username does not exist, so the answer takes as long as for a wrong password and the
+# timing does not tell which usernames exist
+def dummy_password_hash():
+    hasher = app.config['PASSWORD_HASHER']
+    cost = password_cost(hasher)
+    if (hasher, cost) not in DUMMY_PASSWORD_HASHES:
+        DUMMY_PASSWORD_HASHES[(hasher, cost)] = hash_password(secrets.token_hex(16), hasher, cost)
+    return DUMMY_PASSWORD_HASHES[(hasher, cost)]
+
+
+def password_needs_rehash(stored):
+    hasher = app.config['PASSWORD_HASHER']
+    return not is_password_hash(stored) or stored.split('$')[:2] != [hasher, str(password_cost(hasher))]
+
+
 class Users(UserMixin, db.Model):
     id = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=True)
-    username = db.Column(db.String(25), nullable=False)
-    password = db.Column(db.String(25), nullable=False)
+    username = db.Column(db.String(25), nullable=False, index=True, unique=True)
+    password = db.Column(db.String(200), nullable=False)
 
     def check_password(self, password):
-        return self.password == password
+        return verify_password(self.password, password)
+
+    def set_password(self, password):
+        self.password = hash_password(password)
+
+    def __str__(self):
+        return self.username
 
 
 class Classes(db.Model):
     id = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=True)
-    class_name = db.Column(db.String(100), nullable=False)
+    class_name = db.Column(db.String(100), nullable=False, index=True)
     timeslot = db.Column(db.String(100), nullable=False)
     size = db.Column(db.Integer, nullable=False)
-    enrolled = db.Column(db.Integer, nullable=False)
-    teacher_id = db.Column(db.Integer, db.ForeignKey('teachers.id'), nullable=False)
+    enrolled = db.Column(db.Integer, nullable=False, default=0)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('teachers.id'), nullable=False, index=True)
     students = db.relationship('Students', secondary='enrollment')
 
+    @db.validates('timeslot')
+    def validate_timeslot(self, key, timeslot):
+        parse_timeslot(timeslot)
+        return timeslot
+
+    def __str__(self):
+        return self.class_name
+
 
 class Students(db.Model):
     id = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=True)
     first_name = db.Column(db.String(25), nullable=False)
-    last_name = db.Column(db.String(25), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    last_name = db.Column(db.String(25), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True, unique=True)
     classes = db.relationship('Classes', secondary='enrollment')
 
+    def __str__(self):
+        return f'{self.first_name} {self.last_name}'
+
 
 class Teachers(AdminMixin, db.Model):
     id = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=True)
     first_name = db.Column(db.String(25), nullable=False)
     last_name = db.Column(db.String(25), nullable=False)
-    user_id = db.Column(db.String(10), db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True, unique=True)
     classes = db.relationship('Classes', backref=db.backref('classes', lazy=True))
 
+    def __str__(self):
+        return f'{self.first_name} {self.last_name}'
+
 
 # joint table for M:M relationships
 class Enrollment(db.Model):
+    __table_args__ = (
+        db.Index('ix_enrollment_student_class', 'student_id', 'class_id', unique=True),
+        db.Index('ix_enrollment_class_id', 'class_id'),
+    )
     id = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=True)
     class_id = db.Column('class_id', db.Integer, db.ForeignKey('classes.id'))
     student_id = db.Column('student_id', db.Integer, db.ForeignKey('students.id'))
     grade = db.Column('grade', db.String(4), nullable=False)
+    student = db.relationship('Students', overlaps='classes,students')
+    course = db.relationship('Classes', overlaps='classes,students')
 
 
-# The following view classes are views added to admin page
-class UserView(AdminMixin, sqla.ModelView):
-    column_exclude_list = 'password'
-    pass
-
-
-class ClassView(AdminMixin, sqla.ModelView):
-    pass
-
-
-class StudentView(AdminMixin, sqla.ModelView):
-    pass
-
-
-class TeacherView(AdminMixin, sqla.ModelView):
-    pass
+# ordered queue of students waiting for a seat in a full class, the autoincrement id gives the order
+class Waitlist(db.Model):
+    __table_args__ = (
+        db.Index('ix_waitlist_class_student', 'class_id', 'student_id', unique=True),
+    )
+    id = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=True)
+    class_id = db.Column(db.Integer, db.ForeignKey('classes.id'), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
 
 
-class EnrollmentView(AdminMixin, sqla.ModelView):
-    pass
+# one weekly meeting of a class, parsed from Classes.timeslot whenever a class is saved
+class ClassMeeting(db.Model):
+    __table_args__ = (
+        db.Index('ix_class_meeting_class_id', 'class_id'),
+    )
+    id = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=True)
+    class_id = db.Column(db.Integer, db.ForeignKey('classes.id'), nullable=False)
+    day = db.Column(db.String(1), nullable=False)
+    start_minute = db.Column(db.Integer, nullable=False)
+    end_minute = db.Column(db.Integer, nullable=False)
+
+
+GRADE_BUCKETS = ('a', 'b', 'c', 'd', 'f')
+
+
+# grade aggregates of a class. The rows, and Classes.enrolled, are kept up to date by the triggers in
+# STATS_TRIGGERS, so every write to enrollment (ORM, bulk UPDATE/DELETE, admin forms) is counted. Numeric grades
+# make up the mean and every grade falls into one letter bucket
+class ClassStats(db.Model):
+    class_id = db.Column(db.Integer, db.ForeignKey('classes.id'), primary_key=True, autoincrement=False)
+    grade_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    grade_sum = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    grade_a = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    grade_b = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    grade_c = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    grade_d = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    grade_f = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    @property
+    def average(self):
+        return self.grade_sum / self.grade_count if self.grade_count else None
+
+    @property
+    def histogram(self):
+        return {bucket.upper(): getattr(self, f'grade_{bucket}') for bucket in GRADE_BUCKETS}
+
+
+# SQL for the letter bucket of a grade column: numbers use a 90/80/70/60 scale, letter grades their first letter
+def grade_bucket_sql(grade):
+    score = f'CAST({grade} AS REAL)'
+    return (f"(CASE WHEN {grade} GLOB '[0-9]*' THEN (CASE WHEN {score} >= 90 THEN 'a' WHEN {score} >= 80 THEN 'b' "
+            f"WHEN {score} >= 70 THEN 'c' WHEN {score} >= 60 THEN 'd' ELSE 'f' END) "
+            f"ELSE lower(substr({grade}, 1, 1)) END)")
+
+
+# trigger body statements adding (sign '+') or removing (sign '-') the NEW/OLD enrollment row from the stats
+def stats_change_sql(row, sign):
+    numeric = f"({row}.grade GLOB '[0-9]*')"
+    bucket = grade_bucket_sql(f'{row}.grade')
+    columns = [f'grade_count = grade_count {sign} {numeric}',
+               f'grade_sum = grade_sum {sign} (CASE WHEN {numeric} THEN CAST({row}.grade AS REAL) ELSE 0 END)']
+    columns += [f"grade_{b} = grade_{b} {sign} ({bucket} = '{b}')" for b in GRADE_BUCKETS]
+    enrolled = 'enrolled + 1' if sign == '+' else 'MAX(enrolled - 1, 0)'
+    return (f'INSERT OR IGNORE INTO class_stats (class_id) SELECT {row}.class_id WHERE {row}.class_id IS NOT NULL; '
+            f'UPDATE class_stats SET {", ".join(columns)} WHERE class_id = {row}.class_id; '
+            f'UPDATE classes SET enrolled = {enrolled} WHERE id = {row}.class_id; ')
+
+
+STATS_TRIGGERS = {
+    'enrollment_stats_insert': f'AFTER INSERT ON enrollment BEGIN {stats_change_sql("NEW", "+")}END',
+    'enrollment_stats_delete': f'AFTER DELETE ON enrollment BEGIN {stats_change_sql("OLD", "-")}END',
+    'enrollment_stats_update': f'AFTER UPDATE OF grade, class_id ON enrollment '
+                               f'BEGIN {stats_change_sql("OLD", "-")}{stats_change_sql("NEW", "+")}END',
+}
+
+# create_all installs the triggers together with the enrollment table, the seat limit in add_class relies on
+# them. migrate_db adds them to databases created before they existed
+for name, definition in STATS_TRIGGERS.items():
+    event.listen(Enrollment.__table__, 'after_create',
+                 DDL(f'CREATE TRIGGER IF NOT EXISTS {name} {definition}').execute_if(dialect='sqlite'))
+
+
+# rebuild Classes.enrolled and class_stats from the enrollment table in three set-based statements
+def reconcile_stats_sql():
+    bucket = grade_bucket_sql('grade')
+    columns = ', '.join(f'grade_{b}' for b in GRADE_BUCKETS)
+    counts = ', '.join(f"SUM({bucket} = '{b}')" for b in GRADE_BUCKETS)
+    return [
+        'UPDATE classes SET enrolled = (SELECT COUNT(*) FROM enrollment WHERE enrollment.class_id = classes.id)',
+        'DELETE FROM class_stats',
+        f'INSERT INTO class_stats (class_id, grade_count, grade_sum, {columns}) '
+        f"SELECT class_id, SUM(grade GLOB '[0-9]*'), "
+        f"SUM(CASE WHEN grade GLOB '[0-9]*' THEN CAST(grade AS REAL) ELSE 0 END), {counts} "
+        f'FROM enrollment WHERE class_id IS NOT NULL GROUP BY class_id',
+    ]
+
+
+@event.listens_for(Classes, 'after_insert')
+@event.listens_for(Classes, 'after_update')
+def save_class_meetings(mapper, connection, target):
+    if not db.inspect(target).attrs.timeslot.history.has_changes():
+        return
+    table = ClassMeeting.__table__
+    connection.execute(table.delete().where(table.c.class_id == target.id))
+    connection.execute(table.insert(), [
+        {'class_id': target.id, 'day': day, 'start_minute': start, 'end_minute': end}
+        for day, start, end in parse_timeslot(target.timeslot)])
+
+
+@event.listens_for(Classes, 'before_delete')
+def delete_class_meetings(mapper, connection, target):
+    table = ClassMeeting.__table__
+    connection.execute(table.delete().where(table.c.class_id == target.id))
+
+
+@event.listens_for(Classes, 'before_delete')
+def delete_class_stats(mapper, connection, target):
+    table = ClassStats.__table__
+    connection.execute(table.delete().where(table.c.class_id == target.id))
+
+
+# list pages show a fixed number of rows and, on big tables, an estimated total taken from the largest id
+# instead of a COUNT(*) scan. Searches and filters still get an exact count
+class LargeTableMixin:
+    page_size = 50
+    can_set_page_size = True
+    column_default_sort = ('id', True)
+    approximate_count_threshold = 100000
+
+    def get_count_query(self):
+        if not request.args.get('search') and not any(arg.startswith('flt') for arg in request.args):
+            estimate = self.session.query(db.func.max(self.model.id)).scalar() or 0
+            if estimate > self.approximate_count_threshold:
+                return self.session.query(db.literal(estimate))
+        return super(LargeTableMixin, self).get_count_query()
+
+
+# ids of the students enrolled in a class and of the classes of a student, for the views below
+def class_student_ids(class_id):
+    return [student_id for (student_id,) in db.session.query(Enrollment.student_id).
+            filter(Enrollment.class_id == class_id)]
+
+
+def student_class_ids(student_id):
+    return [class_id for (class_id,) in db.session.query(Enrollment.class_id).
+            filter(Enrollment.student_id == student_id)]
+
+
+# The following view classes are views added to admin page. Searchable and filterable columns are indexed,
+# and related rows shown in the lists are joined into the list query
+class UserView(AdminMixin, LargeTableMixin, sqla.ModelView):
+    column_exclude_list = 'password'
+    column_searchable_list = ('username',)
+    column_filters = ('username',)
+
+    # passwords typed into the admin form are stored hashed
+    def on_model_change(self, form, model, is_created):
+        if not is_password_hash(model.password):
+            model.set_password(model.password)
+
+
+# class edits invalidate the catalog and the pages listing the class. Only a timeslot change reaches the schedule
+# index, and only that of the students in the class; a new, moved or deleted class changes the teacher pages
+class ClassView(AdminMixin, LargeTableMixin, sqla.ModelView):
+    column_list = ('class_name', 'timeslot', 'size', 'enrolled', 'classes')
+    column_labels = {'classes': 'Teacher'}
+    column_select_related_list = ('classes',)
+    column_searchable_list = ('class_name',)
+    column_filters = ('class_name', 'teacher_id')
+    # enrolled is kept by the enrollment triggers and enrollments are edited in their own view
+    form_excluded_columns = ('enrolled', 'students')
+
+    # the history is gone after the commit, so what changed is noted on flask.g for after_model_change
+    def on_model_change(self, form, model, is_created):
+        attrs = db.inspect(model).attrs
+        g.stale_teachers = {teacher.id for teacher in attrs.classes.history.deleted if teacher is not None}
+        g.stale_schedules = []
+        if not is_created and attrs.timeslot.history.has_changes():
+            with db.session.no_autoflush:
+                g.stale_schedules = class_student_ids(model.id)
+
+    def after_model_change(self, form, model, is_created):
+        invalidate_class(model.id)
+        for teacher_id in g.pop('stale_teachers', set()) | {model.teacher_id}:
+            invalidate_teacher(teacher_id)
+        for student_id in g.pop('stale_schedules', []):
+            invalidate_schedule(student_id)
+
+    # the enrollments go with the class
+    def on_model_delete(self, model):
+        g.stale_schedules = class_student_ids(model.id)
+
+    def after_model_delete(self, model):
+        invalidate_class(model.id)
+        invalidate_teacher(model.teacher_id)
+        for student_id in g.pop('stale_schedules', []):
+            invalidate_schedule(student_id)
+
+
+# names are shown on the pages of other users, a student's on the rosters of their classes
+class StudentView(AdminMixin, LargeTableMixin, sqla.ModelView):
+    column_searchable_list = ('last_name',)
+    column_filters = ('last_name', 'user_id')
+
+    def after_model_change(self, form, model, is_created):
+        invalidate_student(model.id)
+        for class_id in student_class_ids(model.id):
+            invalidate_grades(class_id)
+
+    # the enrollments go with the student, freeing their seats
+    def on_model_delete(self, model):
+        g.stale_seats = student_class_ids(model.id)
+
+    def after_model_delete(self, model):
+        invalidate_schedule(model.id)
+        for class_id in g.pop('stale_seats', []):
+            invalidate_seats(class_id)
+
+
+# a teacher's name is shown in the catalog and on the pages of every class they teach. Classes added in the
+# form are taken from their previous teacher, whose page changes too
+class TeacherView(AdminMixin, LargeTableMixin, sqla.ModelView):
+    column_searchable_list = ('last_name',)
+    column_filters = ('user_id',)
+
+    def on_model_change(self, form, model, is_created):
+        g.stale_teachers = {course.teacher_id for course in db.inspect(model).attrs.classes.history.added
+                            if course.teacher_id is not None}
+
+    def after_model_change(self, form, model, is_created):
+        for teacher_id in g.pop('stale_teachers', set()) | {model.id}:
+            invalidate_teacher(teacher_id)
+        invalidate_catalog()
+        for (class_id,) in db.session.query(Classes.id).filter(Classes.teacher_id == model.id):
+            invalidate_grades(class_id)
+
+    def after_model_delete(self, model):
+        invalidate_teacher(model.id)
+        invalidate_catalog()
+
+
+class EnrollmentView(AdminMixin, LargeTableMixin, sqla.ModelView):
+    column_list = ('student', 'course', 'grade')
+    column_select_related_list = ('student', 'course')
+    column_filters = ('class_id', 'student_id')
+    form_columns = ('student', 'course', 'grade')
+
+    # the enrollment triggers update the seat counts, moving a row to another class changes two of them
+    def on_model_change(self, form, model, is_created):
+        for course in db.inspect(model).attrs.course.history.deleted:
+            if course is not None:
+                invalidate_seats(course.id)
+
+    def after_model_change(self, form, model, is_created):
+        invalidate_seats(model.class_id)
+        invalidate_schedule(model.student_id)
+
+    def after_model_delete(self, model):
+        invalidate_seats(model.class_id)
+        invalidate_schedule(model.student_id)
+
+
+class WaitlistView(AdminMixin, LargeTableMixin, sqla.ModelView):
+    column_list = ('class_id', 'student_id')
+    column_filters = ('class_id', 'student_id')
 
 
 # sets up admin page, index_view takes the view perms from AdminIndex()
@@ -121,112 +519,688 @@ admin.add_view(ClassView(Classes, db.session))
 admin.add_view(StudentView(Students, db.session))
 admin.add_view(TeacherView(Teachers, db.session))
 admin.add_view(EnrollmentView(Enrollment, db.session))
+admin.add_view(WaitlistView(Waitlist, db.session))
+
+
+# bring an existing database up to the current schema: missing tables are created, teachers.user_id becomes
+# an INTEGER, duplicate enrollments are removed, every index declared on the models is created, the class
+# statistics triggers are installed and the meetings of classes saved before ClassMeeting existed are filled in
+def migrate_db():
+    db.create_all()
+    raw = db.engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        # SQLite can't change a column type, so teachers is rebuilt with foreign key checks off
+        cursor.execute('PRAGMA foreign_keys=OFF')
+        cursor.execute('BEGIN')
+        columns = {row[1]: row[2] for row in cursor.execute('PRAGMA table_info(teachers)').fetchall()}
+        if columns.get('user_id', 'INTEGER').upper() != 'INTEGER':
+            cursor.execute(
+                'CREATE TABLE teachers_new ('
+                'id INTEGER NOT NULL, first_name VARCHAR(25) NOT NULL, last_name VARCHAR(25) NOT NULL, '
+                'user_id INTEGER NOT NULL, PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES users (id))')
+            cursor.execute(
+                'INSERT INTO teachers_new (id, first_name, last_name, user_id) '
+                'SELECT id, first_name, last_name, CAST(user_id AS INTEGER) FROM teachers')
+            cursor.execute('DROP TABLE teachers')
+            cursor.execute('ALTER TABLE teachers_new RENAME TO teachers')
+        duplicates = cursor.execute(
+            'DELETE FROM enrollment WHERE id NOT IN '
+            '(SELECT MIN(id) FROM enrollment GROUP BY student_id, class_id)').rowcount
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                cursor.execute(str(CreateIndex(index, if_not_exists=True).compile(dialect=db.engine.dialect)))
+        # triggers are recreated so a changed definition replaces the old one, then the stats are rebuilt
+        for name, definition in STATS_TRIGGERS.items():
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+            cursor.execute(f'CREATE TRIGGER {name} {definition}')
+        for statement in reconcile_stats_sql():
+            cursor.execute(statement)
+        unscheduled = cursor.execute(
+            'SELECT id, timeslot FROM classes WHERE id NOT IN (SELECT class_id FROM class_meeting)').fetchall()
+        for class_id, timeslot in unscheduled:
+            cursor.executemany(
+                'INSERT INTO class_meeting (class_id, day, start_minute, end_minute) VALUES (?, ?, ?, ?)',
+                [(class_id, day, start, end) for day, start, end in parse_timeslot(timeslot)])
+        if cursor.execute('PRAGMA foreign_key_check').fetchall():
+            raise RuntimeError('foreign key check failed after migration')
+        raw.commit()
+        cursor.execute('ANALYZE')
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.cursor().execute('PRAGMA foreign_keys=ON')
+        raw.close()
+    return duplicates
+
+
+# rebuild the enrolled counters and grade statistics in bulk, for when the enrollment table was written
+# without the triggers installed (e.g. restored from a backup) or the numbers are suspected to have drifted
+def reconcile_stats():
+    for statement in reconcile_stats_sql():
+        db.session.execute(db.text(statement))
+    db.session.commit()
+    catalog_cache.clear()
+
+
+# the (teacher, student) profiles of a user, resolved at most once per request and kept on flask.g
+def get_profile(user):
+    profiles = g.setdefault('profiles', {})
+    if user.id not in profiles:
+        teacher = Teachers.query.filter(Teachers.user_id == user.id).first()
+        student = None if teacher else Students.query.filter(Students.user_id == user.id).first()
+        profiles[user.id] = (teacher, student)
+    return profiles[user.id]
 
 
+def get_teacher(user):
+    return get_profile(user)[0]
 
-db.create_all()
-db.session.commit()
+
+def get_student(user):
+    return get_profile(user)[1]
 
 
 # return true if user is a Teacher
 def is_teacher(user):
-    teacher = Teachers.query.filter(Teachers.user_id == user.id).first()
-    if teacher:
-        return True
+    return get_teacher(user) is not None
 
 
-def get_user_classes(user):
-    names = []
-    if is_teacher(user):
-        teacher = Teachers.query.filter(Teachers.user_id == user.id).first()
-        for name in teacher.classes:
-            names.append(name.class_name)
-        return names
+# load the schedule of a student or teacher in one joined query, each row carries the class name,
+# teacher name, timeslot, enrolled count and capacity. Teacher rows also get the precomputed grade average
+def get_schedule(user, teacher=False):
+    query = db.session.query(
+        Classes.id, Classes.class_name, Classes.timeslot, Classes.enrolled, Classes.size,
+        (Teachers.first_name + ' ' + Teachers.last_name).label('teacher')
+    ).join(Teachers, Classes.teacher_id == Teachers.id)
+    if teacher:
+        query = query.add_columns((ClassStats.grade_sum / ClassStats.grade_count).label('average')).\
+            outerjoin(ClassStats, ClassStats.class_id == Classes.id).filter(Teachers.user_id == user.id)
     else:
-        student = Students.query.filter(Students.user_id == user.id).first()
-        for name in student.classes:
-            names.append(name.class_name)
-        return names
+        query = query.join(Enrollment, Enrollment.class_id == Classes.id).\
+            join(Students, Students.id == Enrollment.student_id).filter(Students.user_id == user.id)
+    return query.order_by(Classes.id).all()
 
 
-def get_teachers(user):
-    names = []
-    student = Students.query.filter(Students.user_id == user.id).first()
-    for entry in student.classes:
-        teacher = Teachers.query.filter(Teachers.id == entry.teacher_id).first()
-        names.append(teacher.first_name + " " + teacher.last_name)
-    return names
+# small in-process LRU cache whose entries expire after ttl seconds, another backend (e.g. one shared between
+# workers) can be swapped in through set_catalog_cache as long as it has the same get/set/delete/clear methods
+class TTLCache:
+    # entries are only seen by this process
+    per_process = True
 
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
 
-def get_class_times(user):
-    times = []
-    if is_teacher(user):
-        teacher = Teachers.query.filter(Teachers.user_id == user.id).first()
-        for classes in teacher.classes:
-            times.append(classes.timeslot)
-        return times
-    else:
-        student = Students.query.filter(Students.user_id == user.id).first()
-        for classes in student.classes:
-            times.append(classes.timeslot)
-        return times
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
 
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
 
-def get_enrolled_students(user):
-    numbers = []
-    if is_teacher(user):
-        teacher = Teachers.query.filter(Teachers.user_id == user.id).first()
-        for classes in teacher.classes:
-            numbers.append(classes.enrolled)
-        return numbers
-    else:
-        student = Students.query.filter(Students.user_id == user.id).first()
-        for classes in student.classes:
-            numbers.append(classes.enrolled)
-        return numbers
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
 
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+app.config['CATALOG_CACHE_TTL'] = int(os.environ.get('CATALOG_CACHE_TTL', 30))  # seconds
+app.config['CATALOG_CACHE_SIZE'] = int(os.environ.get('CATALOG_CACHE_SIZE', 4096))
+catalog_cache = TTLCache(app.config['CATALOG_CACHE_SIZE'], app.config['CATALOG_CACHE_TTL'])
+
+
+def set_catalog_cache(backend):
+    global catalog_cache
+    catalog_cache = backend
+
+
+# called when a class or teacher row is edited, the seat counts stay cached
+def invalidate_catalog():
+    catalog_cache.delete('catalog')
+    catalog_cache.delete('fragment:catalog')
+    catalog_cache.delete('version:catalog')
+
+
+# called when the enrolled count of a single class changes
+def invalidate_seats(class_id):
+    catalog_cache.delete(f'seats:{class_id}')
+    catalog_cache.delete('fragment:catalog')
+    catalog_cache.delete('version:catalog')
+    catalog_cache.delete(f'version:class:{class_id}')
+
+
+# called when the classes of a student change
+def invalidate_schedule(student_id):
+    catalog_cache.delete(f'schedule:{student_id}')
+    catalog_cache.delete(f'version:student:{student_id}')
+
+
+# called when grades in a class change, or the names on its roster
+def invalidate_grades(class_id):
+    catalog_cache.delete(f'version:class:{class_id}')
+
+
+# called when a class row is edited: its name, size, teacher or meetings show in the catalog and on every page
+# listing the class
+def invalidate_class(class_id):
+    invalidate_catalog()
+    catalog_cache.delete(f'version:class:{class_id}')
+
+
+# called when a teacher's profile or the set of classes they teach changes
+def invalidate_teacher(teacher_id):
+    catalog_cache.delete(f'version:teacher:{teacher_id}')
+
+
+# called when a student's profile changes, their classes are covered by invalidate_schedule
+def invalidate_student(student_id):
+    catalog_cache.delete(f'version:student:{student_id}')
+
+
+# version stamp of a student, a teacher, a class or the catalog ('catalog', None). Invalidating deletes the stamp,
+# so the next read makes up a new one; an evicted or expired stamp changes too, which only costs a re-render
+def get_version(kind, key=None):
+    name = f'version:{kind}' if key is None else f'version:{kind}:{key}'
+    version = catalog_cache.get(name)
+    if version is None:
+        version = secrets.token_hex(8)
+        catalog_cache.set(name, version)
+    return name, version
+
+
+# record that the page being rendered shows data covered by this version stamp. Where the key is known up front
+# it should be called before the data is queried, so a change made while rendering leaves the page with an
+# outdated stamp rather than the reverse
+def depends_on(kind, key=None):
+    if g.get('page_versions') is not None:
+        name, version = get_version(kind, key)
+        g.page_versions[name] = version
 
-def get_class_capacity(user):
-    numbers = []
-    if is_teacher(user):
-        teacher = Teachers.query.filter(Teachers.user_id == user.id).first()
-        for classes in teacher.classes:
-            numbers.append(classes.size)
-        return numbers
-    else:
-        student = Students.query.filter(Students.user_id == user.id).first()
-        for classes in student.classes:
-            numbers.append(classes.size)
-        return numbers
+
+# set by `flask serve` and the development server when this process is the only one serving requests
+app.config['SINGLE_PROCESS'] = False
 
 
-def check_class_capacity(student_class):
-    return student_class.enrolled == student_class.size
+# the version stamps can only answer a 304 on their own if every change bumps them, which is not the case with
+# an in-process cache and several worker processes: a change made through one worker leaves the others' stamps
+def version_stamps_shared():
+    return app.config['SINGLE_PROCESS'] or not getattr(catalog_cache, 'per_process', False)
+
+
+# conditional GET for per-user pages. A rendered page gets an ETag from its body, so a revalidation of an
+# unchanged page is answered with 304 Not Modified after rendering it. When version_stamps_shared(), the stamps
+# the page depends on are also remembered per user and URL with a Last-Modified, and as long as none of them
+# changed a revalidation is answered with 304 straight from the cache and the session cookie, before the user is
+# loaded or anything is queried. Has to wrap login_required so it runs first
+def conditional_page(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = session.get('_user_id')
+        if request.method != 'GET' or user_id is None:
+            return view(*args, **kwargs)
+        key = f'page:{user_id}:{request.full_path}'
+        shared = version_stamps_shared()
+        entry = catalog_cache.get(key) if shared else None
+        if entry is not None:
+            etag, last_modified, versions = entry
+            if request.if_none_match:
+                fresh = etag in request.if_none_match
+            else:
+                fresh = request.if_modified_since is not None and last_modified <= request.if_modified_since
+            if fresh and all(catalog_cache.get(name) == version for name, version in versions.items()):
+                response = Response(status=304)
+                response.set_etag(etag)
+                response.last_modified = last_modified
+                response.headers['Cache-Control'] = 'private, no-cache'
+                return response
+
+        g.page_versions = {}
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200 and g.page_versions:
+            response.add_etag()
+            response.headers['Cache-Control'] = 'private, no-cache'
+            if shared:
+                response.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+                catalog_cache.set(key, (response.get_etag()[0], response.last_modified, g.page_versions))
+            response.make_conditional(request)
+        g.page_versions = None
+        return response
+    return wrapper
+
+
+# load the course catalog joined with the teacher names, the rows are plain dicts so the template cannot go
+# back to the database while rendering. The class list and the seat count of each class are cached
+# separately so an enrollment only reloads the seats of the class it touched
+def get_catalog():
+    classes = catalog_cache.get('catalog')
+    seats = {}
+    if classes is None:
+        rows = db.session.query(
+            Classes.id, Classes.class_name, Classes.timeslot, Classes.enrolled, Classes.size,
+            (Teachers.first_name + ' ' + Teachers.last_name).label('teacher')
+        ).join(Teachers, Classes.teacher_id == Teachers.id).order_by(Classes.id).all()
+        classes = [row._asdict() for row in rows]
+        meetings = {}
+        for class_id, day, start, end in db.session.query(
+                ClassMeeting.class_id, ClassMeeting.day, ClassMeeting.start_minute, ClassMeeting.end_minute):
+            meetings.setdefault(class_id, []).append((day, start, end))
+        for entry in classes:
+            entry['meetings'] = meetings.get(entry['id'], [])
+        catalog_cache.set('catalog', classes)
+        for entry in classes:
+            seats[entry['id']] = entry['enrolled']
+            catalog_cache.set(f'seats:{entry["id"]}', entry['enrolled'])
+    else:
+        missing = []
+        for entry in classes:
+            enrolled = catalog_cache.get(f'seats:{entry["id"]}')
+            if enrolled is None:
+                missing.append(entry['id'])
+            else:
+                seats[entry['id']] = enrolled
+        if missing:
+            for class_id, enrolled in db.session.query(Classes.id, Classes.enrolled).filter(Classes.id.in_(missing)):
+                seats[class_id] = enrolled
+                catalog_cache.set(f'seats:{class_id}', enrolled)
+    return [dict(entry, enrolled=seats.get(entry['id'], entry['enrolled'])) for entry in classes]
+
+
+CONFLICT_MARKER = re.compile(r'<!--conflict:(\d+)-->')
+CONFLICT_NOTE = '<br><small>Conflicts with your schedule</small>'
+
+
+# the catalog table is the same for every student apart from the conflict notes, so it is rendered once with a
+# marker per row and cached until a class or seat count changes. The notes for the classes that conflict with
+# the student's schedule are filled in from the cached schedule index without extra queries per row
+def render_catalog(student, error=''):
+    depends_on('student', student.id)
+    depends_on('catalog')
+    table = catalog_cache.get('fragment:catalog')
+    catalog = catalog_cache.get('catalog') if table is not None else None
+    if catalog is None:
+        catalog = get_catalog()
+        table = render_template('catalog_table.html', catalog=catalog)
+        catalog_cache.set('fragment:catalog', table)
+    schedule = get_schedule_index(student.id)
+    conflicts = {entry['id'] for entry in catalog if entry['id'] not in schedule.class_ids and
+                 schedule.find_conflict(entry['meetings']) is not None}
+    table = CONFLICT_MARKER.sub(lambda match: CONFLICT_NOTE if int(match.group(1)) in conflicts else '', table)
+    return render_template('registration.html', name=student.first_name, catalog_table=Markup(table), error=error)
 
 
+def check_class_capacity(student_class):
+    return student_class.enrolled >= student_class.size
+
+
+# outcomes of add_class
+ENROLLED = 'enrolled'
+CLASS_FULL = 'full'
+ALREADY_ENROLLED = 'already enrolled'
+CLASS_NOT_FOUND = 'not found'
+TIME_CONFLICT = 'time conflict'
+
+# retry policy for writes that hit a locked SQLite database
+LOCK_RETRIES = 5
+LOCK_BACKOFF = 0.05
+
+
+# retry a write transaction with exponential backoff when SQLite reports the database is locked
+def retry_on_lock(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(LOCK_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                db.session.rollback()
+                if 'database is locked' not in str(e) or attempt == LOCK_RETRIES - 1:
+                    raise
+                time.sleep(LOCK_BACKOFF * 2 ** attempt)
+    return wrapper
+
+
+# start the transaction with SQLite's write lock, so the reads deciding a write see the latest committed state
+# of every worker and nothing can change before the write. Other databases lock on the write itself
+def begin_write():
+    if db.engine.dialect.name == 'sqlite' and not db.session.connection().connection.in_transaction:
+        db.session.execute(db.text('BEGIN IMMEDIATE'))
+
+
+# INSERT ... SELECT of an enrollment that only produces a row while the class has a free seat, run as one
+# statement under the write lock. The enrollment trigger then bumps Classes.enrolled
+def enroll_if_seat_free(student_id, class_id):
+    seat_free = db.session.query(Classes.id).filter(Classes.id == class_id, Classes.enrolled < Classes.size).exists()
+    return db.session.execute(Enrollment.__table__.insert().from_select(
+        ['student_id', 'class_id', 'grade'],
+        db.select(db.literal(student_id), db.literal(class_id), db.literal('100')).where(seat_free))).rowcount
+
+
+# the schedule checks, the capacity check and the insert all run under the write lock taken by begin_write, the
+# capacity check and the insert in a single conditional statement. A duplicate is also caught by the unique
+# enrollment index
+@retry_on_lock
 def add_class(student_id, class_id):
-    class_to_add = Classes.query.filter(Classes.id == class_id).first()
-    new_size = class_to_add.enrolled + 1
-    updated = Classes.query.filter_by(id=class_id).update(dict(enrolled=new_size))
-    db.session.add(Enrollment(student_id=student_id, class_id=class_id, grade="100"))
+    begin_write()
+    if db.session.query(Classes.id).filter(Classes.id == class_id).first() is None:
+        db.session.rollback()
+        return CLASS_NOT_FOUND
+    meetings = db.session.query(ClassMeeting.day, ClassMeeting.start_minute, ClassMeeting.end_minute).\
+        filter(ClassMeeting.class_id == class_id).all()
+    schedule = load_schedule_index(student_id)
+    if class_id in schedule.class_ids:
+        db.session.rollback()
+        return ALREADY_ENROLLED
+    if schedule.find_conflict(meetings) is not None:
+        db.session.rollback()
+        return TIME_CONFLICT
+    try:
+        inserted = enroll_if_seat_free(student_id, class_id)
+    except IntegrityError:
+        db.session.rollback()
+        return ALREADY_ENROLLED
+    if not inserted:
+        db.session.rollback()
+        return CLASS_FULL
+    Waitlist.query.filter_by(class_id=class_id, student_id=student_id).delete(synchronize_session=False)
     db.session.commit()
+    invalidate_seats(class_id)
+    invalidate_schedule(student_id)
+    return ENROLLED
+
+
+# put a student at the end of the waitlist of a full class and return their position, None if the class does
+# not exist or is not full (anymore) or they are already enrolled
+@retry_on_lock
+def join_waitlist(student_id, class_id):
+    begin_write()
+    full = db.session.query(Classes.id).filter(Classes.id == class_id, Classes.enrolled >= Classes.size).first()
+    if full is None or is_enrolled(class_id, student_id):
+        db.session.rollback()
+        return None
+    entry = Waitlist.query.filter_by(class_id=class_id, student_id=student_id).first()
+    if entry is None:
+        entry = Waitlist(class_id=class_id, student_id=student_id)
+        db.session.add(entry)
+    db.session.commit()
+    return Waitlist.query.filter(Waitlist.class_id == class_id, Waitlist.id <= entry.id).count()
 
 
+# the freed seat goes to the first waiting student whose schedule it fits, in the same transaction; entries
+# that would conflict keep their place. The enrollment triggers keep the counter right either way.
+# Dropping a class the student is only waitlisted for leaves the waitlist
+@retry_on_lock
 def drop_class(student_id, class_id):
-    class_to_drop = Classes.query.filter(Classes.id == class_id).first()
-    new_size = class_to_drop.enrolled - 1
-    updated = Classes.query.filter_by(id=class_id).update(dict(enrolled=new_size))
-    Enrollment.query.filter(Enrollment.class_id == class_id, Enrollment.student_id == student_id).delete()
+    promoted = None
+    deleted = Enrollment.query.filter(Enrollment.class_id == class_id, Enrollment.student_id == student_id).\
+        delete(synchronize_session=False)
+    if deleted:
+        meetings = db.session.query(ClassMeeting.day, ClassMeeting.start_minute, ClassMeeting.end_minute).\
+            filter(ClassMeeting.class_id == class_id).all()
+        for entry in Waitlist.query.filter_by(class_id=class_id).order_by(Waitlist.id).all():
+            schedule = load_schedule_index(entry.student_id)
+            if class_id in schedule.class_ids:
+                db.session.delete(entry)
+                continue
+            if schedule.find_conflict(meetings) is not None:
+                continue
+            db.session.add(Enrollment(student_id=entry.student_id, class_id=class_id, grade="100"))
+            db.session.delete(entry)
+            promoted = entry.student_id
+            break
+    else:
+        deleted = Waitlist.query.filter_by(class_id=class_id, student_id=student_id).\
+            delete(synchronize_session=False)
     db.session.commit()
+    if deleted:
+        invalidate_seats(class_id)
+        invalidate_schedule(student_id)
+    if promoted:
+        invalidate_schedule(promoted)
+    return bool(deleted)
 
 
+# indexed existence check on enrollment(student_id, class_id)
 def is_enrolled(class_id, student_id):
-    student = Students.query.filter_by(id=student_id).first()
-    classes = student.classes
-    for entry in classes:
-        if entry.id == class_id:
-            return True
-    return False
+    return db.session.query(
+        Enrollment.query.filter_by(class_id=class_id, student_id=student_id).exists()).scalar()
+
+
+TIMESLOT_PATTERN = re.compile(
+    r'^([MTWRFSU]+)\s+(\d{1,2}):(\d{2})\s*(AM|PM)?\s*-\s*(\d{1,2}):(\d{2})\s*(AM|PM)?$', re.IGNORECASE)
+
+
+def to_minutes(hour, minute, suffix):
+    hour = int(hour)
+    if suffix:
+        hour = hour % 12 + (12 if suffix.upper() == 'PM' else 0)
+    return hour * 60 + int(minute)
+
+
+# parse a timeslot like 'MWF 10:00-10:50 AM' into (day, start, end) meetings with the times in minutes,
+# a single AM/PM suffix applies to both times unless that would put the start after the end
+def parse_timeslot(timeslot):
+    match = TIMESLOT_PATTERN.match(timeslot.strip())
+    if match is None:
+        raise ValueError(f'Unrecognised timeslot {timeslot!r}')
+    days, start_hour, start_minute, start_suffix, end_hour, end_minute, end_suffix = match.groups()
+    end = to_minutes(end_hour, end_minute, end_suffix)
+    start = to_minutes(start_hour, start_minute, start_suffix or end_suffix)
+    if start >= end and start_suffix is None and end_suffix:
+        start = to_minutes(start_hour, start_minute, 'AM')
+    if start >= end:
+        raise ValueError(f'Timeslot {timeslot!r} ends before it starts')
+    return [(day, start, end) for day in days.upper()]
+
+
+def meetings_overlap(first, second):
+    return any(a_day == b_day and a_start < b_end and b_start < a_end
+               for a_day, a_start, a_end in first for b_day, b_start, b_end in second)
+
+
+# the weekly meetings of a student's classes, sorted by start time per day. Along with the starts it keeps the
+# latest end (and its class) seen so far, so a conflict is found with one binary search per meeting
+class ScheduleIndex:
+    def __init__(self, meetings):
+        self.class_ids = set()
+        self._days = {}
+        for class_id, day, start, end in sorted(meetings, key=lambda meeting: meeting[2]):
+            self.class_ids.add(class_id)
+            starts, latest = self._days.setdefault(day, ([], []))
+            if latest and latest[-1][0] >= end:
+                latest.append(latest[-1])
+            else:
+                latest.append((end, class_id))
+            starts.append(start)
+
+    # id of an enrolled class that overlaps any of the given (day, start, end) meetings, None if there is none
+    def find_conflict(self, meetings):
+        for day, start, end in meetings:
+            starts, latest = self._days.get(day, ((), ()))
+            position = bisect_left(starts, end)
+            if position and latest[position - 1][0] > start:
+                return latest[position - 1][1]
+        return None
+
+
+# the schedule index of a student built from one query, classes without parsed meetings still count as enrolled
+def load_schedule_index(student_id):
+    rows = db.session.query(
+        Enrollment.class_id, ClassMeeting.day, ClassMeeting.start_minute, ClassMeeting.end_minute
+    ).outerjoin(ClassMeeting, ClassMeeting.class_id == Enrollment.class_id).\
+        filter(Enrollment.student_id == student_id).all()
+    schedule = ScheduleIndex([row for row in rows if row.day is not None])
+    schedule.class_ids.update(row.class_id for row in rows)
+    return schedule
+
+
+# the schedule index cached until the student's classes change, only for display. Writes use
+# load_schedule_index inside their transaction since another worker may have changed the enrollments
+def get_schedule_index(student_id):
+    schedule = catalog_cache.get(f'schedule:{student_id}')
+    if schedule is None:
+        schedule = load_schedule_index(student_id)
+        catalog_cache.set(f'schedule:{student_id}', schedule)
+    return schedule
+
+
+# register a student in several classes at once, all the checks are set-based queries and either every
+# class is added in one transaction or none is. Returns a list of {class_id, error} dicts, empty on success
+@retry_on_lock
+def add_classes(student_id, class_ids):
+    class_ids = list(dict.fromkeys(class_ids))
+    begin_write()
+    requested = {c.id: c for c in Classes.query.filter(Classes.id.in_(class_ids))}
+    meetings = {}
+    for class_id, day, start, end in db.session.query(
+            ClassMeeting.class_id, ClassMeeting.day, ClassMeeting.start_minute, ClassMeeting.end_minute
+    ).filter(ClassMeeting.class_id.in_(class_ids)):
+        meetings.setdefault(class_id, []).append((day, start, end))
+    schedule = load_schedule_index(student_id)
+    errors = []
+    accepted = []
+    for class_id in class_ids:
+        course = requested.get(class_id)
+        if course is None:
+            errors.append({'class_id': class_id, 'error': 'Class does not exist'})
+            continue
+        if class_id in schedule.class_ids:
+            errors.append({'class_id': class_id, 'error': 'You are currently enrolled in this class'})
+            continue
+        if check_class_capacity(course):
+            errors.append({'class_id': class_id, 'error': f'Class {course.class_name} is Full'})
+            continue
+        conflicts = [schedule.find_conflict(meetings.get(class_id, []))]
+        conflicts += [other.id for other in accepted
+                      if meetings_overlap(meetings.get(class_id, []), meetings.get(other.id, []))]
+        conflicts = [other for other in conflicts if other is not None]
+        if conflicts:
+            errors.append({'class_id': class_id, 'error': f'Time conflict with class {conflicts[0]}'})
+            continue
+        accepted.append(course)
+    if errors or not accepted:
+        db.session.rollback()
+        return errors
+
+    try:
+        inserted = sum(enroll_if_seat_free(student_id, class_id) for class_id in class_ids)
+        if inserted != len(class_ids):
+            db.session.rollback()
+            return [{'class_id': None, 'error': 'A class filled up while registering, please try again'}]
+        Waitlist.query.filter(Waitlist.student_id == student_id, Waitlist.class_id.in_(class_ids)).\
+            delete(synchronize_session=False)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return [{'class_id': None, 'error': 'You are currently enrolled in one of these classes'}]
+    for class_id in class_ids:
+        invalidate_seats(class_id)
+    invalidate_schedule(student_id)
+    return []
+
+
+# per-endpoint request instrumentation, the numbers are kept per worker process and exposed at /metrics.
+# Requests running more than SLOW_REQUEST_QUERY_THRESHOLD queries are logged, 0 turns the log off
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+app.config['SLOW_REQUEST_QUERY_THRESHOLD'] = int(os.environ.get('SLOW_REQUEST_QUERY_THRESHOLD', 0))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+# a Prometheus style histogram with one series per endpoint, bucket counts are cumulative
+class Histogram:
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, value):
+        with self._lock:
+            counts, total, count = self._series.get(endpoint, ([0] * len(self.buckets), 0, 0))
+            counts = [n + 1 if value <= bound else n for n, bound in zip(counts, self.buckets)]
+            self._series[endpoint] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted(self._series.items())
+        for endpoint, (counts, total, count) in series:
+            for bound, n in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {n}')
+            lines.append(f'{self.name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{endpoint="{endpoint}"}} {total}')
+            lines.append(f'{self.name}_count{{endpoint="{endpoint}"}} {count}')
+        return lines
+
+
+request_latency = Histogram('app_request_duration_seconds', 'Total request latency.', LATENCY_BUCKETS)
+request_db_time = Histogram('app_request_db_seconds', 'Time spent in SQL per request.', LATENCY_BUCKETS)
+request_queries = Histogram('app_request_queries', 'SQL statements run per request.', QUERY_COUNT_BUCKETS)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    if has_request_context() and 'query_count' in g:
+        g.query_count += 1
+        g.db_time += elapsed
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+    g.db_time = 0.0
+
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' not in g:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    elapsed = time.perf_counter() - g.request_started
+    request_latency.observe(endpoint, elapsed)
+    request_db_time.observe(endpoint, g.db_time)
+    request_queries.observe(endpoint, g.query_count)
+    threshold = app.config['SLOW_REQUEST_QUERY_THRESHOLD']
+    if threshold and g.query_count > threshold:
+        app.logger.warning('%s %s ran %d queries (%.1f ms in SQL, %.1f ms total)', request.method, request.path,
+                           g.query_count, g.db_time * 1000, elapsed * 1000)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    lines = request_latency.render() + request_db_time.render() + request_queries.render()
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/')
@@ -249,8 +1223,15 @@ def login(error='Invalid username or password'):
     # when a form is submitted using POST, execute login logic
     if request.method == 'POST':
         user = Users.query.filter_by(username=request.form['username']).first()
-        if user is None or not user.check_password(request.form['password']):
+        if user is None:
+            verify_password(dummy_password_hash(), request.form['password'])
+            return render_template('login.html', error=error)
+        if not user.check_password(request.form['password']):
             return render_template('login.html', error=error)
+        # upgrade plaintext passwords and hashes made with older cost settings
+        if password_needs_rehash(user.password):
+            user.set_password(request.form['password'])
+            db.session.commit()
         login_user(user)
         if is_teacher(user):
             return redirect(url_for('teacher_page', user_id=current_user.id))
@@ -260,82 +1241,60 @@ def login(error='Invalid username or password'):
 
 # app route for a logged in user who isn't a teacher
 @app.route('/user/classes', methods=['POST', 'GET'])
+@conditional_page
 @login_required
 def user_page():
     if request.method == 'POST':
         return redirect(url_for('registration'))
     else:
-        user = Users.query.filter_by(id=current_user.id).first()
-        student = Students.query.filter(Students.user_id == user.id).first()
+        student = get_student(current_user)
         name = student.first_name
-        classes = get_user_classes(user)
-        teachers = get_teachers(user)
-        times = get_class_times(user)
-        enrolled = get_enrolled_students(user)
-        cap = get_class_capacity(user)
-        return render_template(
-            'user_page.html', classes=classes, teachers=teachers, times=times, enrolled=enrolled, cap=cap, name=name
-        )
+        depends_on('student', student.id)
+        schedule = get_schedule(current_user)
+        for row in schedule:
+            depends_on('class', row.id)
+        return render_template('user_page.html', schedule=schedule, name=name)
 
 
 @app.route('/teacher', methods=['POST', 'GET'])
+@conditional_page
+@login_required
 def teacher_page():
-    user = Users.query.filter_by(id=current_user.id).first()
-    teacher = Teachers.query.filter(Teachers.user_id == user.id).first()
+    teacher = get_teacher(current_user)
+    depends_on('teacher', teacher.id)
     name = "Dr. " + teacher.last_name
-    classes = get_user_classes(user)
-    teachers = []
-    for entry in classes:
-        c = Classes.query.filter(Classes.class_name == entry).first()
-        teacher = Teachers.query.filter(c.teacher_id == Teachers.id).first()
-        teachers.append(teacher.first_name + " " + teacher.last_name)
-    times = get_class_times(user)
-    enrolled = get_enrolled_students(user)
-    cap = get_class_capacity(user)
-    return render_template(
-        'teacher_page.html', classes=classes, enrolled=enrolled, times=times, name=name, cap=cap, teachers=teachers
-    )
+    schedule = get_schedule(current_user, teacher=True)
+    for row in schedule:
+        depends_on('class', row.id)
+    return render_template('teacher_page.html', schedule=schedule, name=name)
 
 
 @app.route('/user/registration', methods=['POST', 'DELETE', 'GET'])
+@conditional_page
 @login_required
 def registration():
-    user = Users.query.filter_by(id=current_user.id).first()
-    student = Students.query.filter(Students.user_id == user.id).first()
-    name = student.first_name
-    classes = Classes.query.all()
-    class_names = []
-    times = []
-    enrolled = []
-    cap = []
-    for c in classes:
-        class_names.append(c.class_name)
-        times.append(c.timeslot)
-        enrolled.append(c.enrolled)
-        cap.append(c.size)
+    student = get_student(current_user)
 
     if request.method == 'POST':
         class_id = int(request.form['reg_button'])
-        selected_class = Classes.query.filter(Classes.id == class_id).first()
-        student = Students.query.filter(Students.user_id == current_user.id).first()
-        if check_class_capacity(selected_class):
-            return render_template(
-                'registration.html', class_names=class_names, times=times, enrolled=enrolled, cap=cap,
-                name=name, classes=classes, teachers=Teachers,
-                error=f'Class {Classes.query.filter_by(id=class_id).first().class_name} is Full!')
-        else:
-            if not is_enrolled(class_id, student.id):
-                add_class(student.id, class_id)
-                return redirect(url_for('registration'))
-            else:
-                return render_template(
-                    'registration.html', class_names=class_names, times=times, enrolled=enrolled, cap=cap,
-                    name=name, classes=classes, teachers=Teachers, error='You are currently enrolled in this class!')
-        return redirect(url_for('user_page'))
+        result = add_class(student.id, class_id)
+        if result == CLASS_FULL:
+            selected_class = Classes.query.filter(Classes.id == class_id).first()
+            position = join_waitlist(student.id, class_id)
+            if position is None:
+                return render_catalog(student, error='Could not join the waitlist for this class, please try again!')
+            return render_catalog(
+                student, error=f'Class {selected_class.class_name} is Full! You are #{position} on the waitlist '
+                            f'and will be enrolled automatically when a seat opens.')
+        elif result == CLASS_NOT_FOUND:
+            return render_catalog(student, error='This class does not exist!'), 404
+        elif result == ALREADY_ENROLLED:
+            return render_catalog(student, error='You are currently enrolled in this class!')
+        elif result == TIME_CONFLICT:
+            return render_catalog(student, error='This class conflicts with your schedule!')
+        return redirect(url_for('registration'))
 
-    return render_template(
-        'registration.html', class_names=class_names, times=times, enrolled=enrolled, cap=cap,
-        name=name, classes=classes, teachers=Teachers, error='')
+    return render_catalog(student)
 
 
 @app.route('/logout')
@@ -345,203 +1304,848 @@ def logout():
     return redirect(url_for('login'))
 
 
-@app.route('/class/cs106', methods=['GET', 'POST'])
+@app.route('/user/drop', methods=['POST', 'GET'])
 @login_required
-def class_CS106():
-    if not is_teacher(current_user):
-        flash('You do not have permission to view this page')
-        return redirect(url_for('login'))
-    student_names = []
-    students = []
-    grades = {}
-    course = Classes.query.filter_by(class_name='CS106').first()
-    enrolled = Enrollment.query.filter(Enrollment.class_id == course.id)
-    for student in course.students:
-        student_names.append(student.first_name + " " + student.last_name)
-        students.append(student)
-    for x in enrolled:
-        for y in students:
-            if y.id == x.student_id:
-                name = y.first_name + ' ' + y.last_name
-                grades[name] = x.grade
-    return render_template('cse106.html', students=student_names, grades=grades)
-
-
-@app.route('/class/cs162', methods=['GET', 'POST'])
+def drop_user_class():
+    student = get_student(current_user)
+
+    if request.method == 'POST':
+        class_id = int(request.form['drop_button'])
+        if not drop_class(student.id, class_id):
+            return render_catalog(student, error='You are not currently enrolled in this class!')
+        return redirect(url_for('registration'))
+    return redirect(url_for('registration'))
+
+
+# cart registration, takes a JSON {"class_ids": [...]} body or a form with repeated class_ids fields
+@app.route('/user/registration/batch', methods=['POST'])
 @login_required
-def class_CS162():
-    if not is_teacher(current_user):
-        flash('You do not have permission to view this page')
-        return redirect(url_for('login'))
-    student_names = []
-    students = []
-    grades = {}
-    course = Classes.query.filter_by(class_name='CS162').first()
-    enrolled = Enrollment.query.filter(Enrollment.class_id == course.id)
-    for student in course.students:
-        student_names.append(student.first_name + " " + student.last_name)
-        students.append(student)
-    for x in enrolled:
-        for y in students:
-            if y.id == x.student_id:
-                name = y.first_name + ' ' + y.last_name
-                grades[name] = x.grade
-    return render_template('cs162.html', students=student_names, grades=grades)
-
-
-@app.route('/class/math101', methods=['GET', 'POST'])
+def batch_registration():
+    student = get_student(current_user)
+    if student is None:
+        return jsonify(error='Only students can register for classes'), 403
+    if request.is_json:
+        body = request.get_json(silent=True)
+        class_ids = body.get('class_ids') if isinstance(body, dict) else None
+        if isinstance(class_ids, list) and \
+                not all(isinstance(class_id, int) and not isinstance(class_id, bool) for class_id in class_ids):
+            class_ids = None
+    else:
+        class_ids = request.form.getlist('class_ids')
+    if not isinstance(class_ids, list):
+        return jsonify(error='class_ids must be a list of class ids'), 400
+    try:
+        class_ids = [int(class_id) for class_id in class_ids]
+    except (TypeError, ValueError):
+        return jsonify(error='class_ids must be a list of class ids'), 400
+    if not class_ids:
+        return jsonify(error='class_ids must be a list of class ids'), 400
+    errors = add_classes(student.id, class_ids)
+    if errors:
+        return jsonify(errors=errors), 409
+    return jsonify(enrolled=list(dict.fromkeys(class_ids)))
+
+
+# number of students shown per roster page
+ROSTER_PAGE_SIZE = 50
+
+
+# one page of a class roster as (name, grade) rows, built from a single join of Enrollment and Students;
+# one extra row is fetched to tell whether there is a next page
+def get_roster(class_id, page=1, per_page=ROSTER_PAGE_SIZE):
+    rows = db.session.query(
+        (Students.first_name + ' ' + Students.last_name).label('name'), Enrollment.grade
+    ).join(Enrollment, Enrollment.student_id == Students.id).filter(Enrollment.class_id == class_id).\
+        order_by(Students.last_name, Students.first_name, Students.id).\
+        offset((page - 1) * per_page).limit(per_page + 1).all()
+    return rows[:per_page], len(rows) > per_page
+
+
+@app.route('/class/<int:class_id>', methods=['GET', 'POST'])
+@conditional_page
 @login_required
-def class_Math101():
+def class_roster(class_id):
     if not is_teacher(current_user):
         flash('You do not have permission to view this page')
         return redirect(url_for('login'))
-    student_names = []
-    students = []
-    grades = {}
-    course = Classes.query.filter_by(class_name='Math101').first()
-    enrolled = Enrollment.query.filter(Enrollment.class_id == course.id)
-    for student in course.students:
-        student_names.append(student.first_name + " " + student.last_name)
-        students.append(student)
-    for x in enrolled:
-        for y in students:
-            if y.id == x.student_id:
-                name = y.first_name + ' ' + y.last_name
-                grades[name] = x.grade
-    return render_template('Math101.html', students=student_names, grades=grades)
-
-
-@app.route('/change_grade_106', methods=['GET', 'POST'])
-@login_required
-def change_grade_106():
-    if not is_teacher(current_user):
-        redirect(url_for('login'))
-    if request.method == 'POST':
-        fname = request.form['first']
-        lname = request.form['last']
-        student = Students.query.filter(Students.first_name == fname and Students.last_name == lname)
-        grade = request.form['grade']
-        if student.scalar() is not None:
-            record = db.session.query(Enrollment).filter(Enrollment.student_id == student.first().id).\
-                filter(Enrollment.class_id == 3)
-            if record.scalar() is not None:
-                record.first().grade = grade
-                db.session.commit()
-            return redirect(url_for('class_CS106'))
-    return redirect(url_for('login'))
+    depends_on('class', class_id)
+    course = Classes.query.get_or_404(class_id)
+    page = max(request.args.get('page', 1, type=int), 1)
+    roster, has_next = get_roster(class_id, page)
+    stats = ClassStats.query.get(class_id) or ClassStats(class_id=class_id)
+    return render_template('class_roster.html', course=course, roster=roster, page=page, has_next=has_next,
+                           stats=stats)
 
 
-@app.route('/change_grade_162', methods=['GET', 'POST'])
+# set the grade of a student in a class, matched by first and last name, in a single UPDATE
+@app.route('/class/<int:class_id>/grade', methods=['POST'])
 @login_required
-def change_grade_162():
+def change_grade(class_id):
     if not is_teacher(current_user):
-        redirect(url_for('login'))
-    if request.method == 'POST':
-        fname = request.form['first']
-        lname = request.form['last']
-        student = Students.query.filter(Students.first_name == fname and Students.last_name == lname)
-        grade = request.form['grade']
-        if student.scalar() is not None:
-            record = db.session.query(Enrollment).filter(Enrollment.student_id == student.first().id).\
-                filter(Enrollment.class_id == 4)
-            if record.scalar() is not None:
-                record.first().grade = grade
-                db.session.commit()
-            return redirect(url_for('class_CS162'))
-    return redirect(url_for('login'))
+        return redirect(url_for('login'))
+    student_ids = db.session.query(Students.id).filter(
+        Students.first_name == request.form['first'], Students.last_name == request.form['last'])
+    Enrollment.query.filter(Enrollment.class_id == class_id, Enrollment.student_id.in_(student_ids)).\
+        update(dict(grade=request.form['grade']), synchronize_session=False)
+    db.session.commit()
+    invalidate_grades(class_id)
+    return redirect(url_for('class_roster', class_id=class_id))
+
+
+# submitted (student_id, class_id) pairs checked per query, 2 parameters each stays under SQLite's old 999 limit
+GRADE_CHECK_CHUNK = 400
+
+
+# apply a batch of grade rows (dicts with student_id, class_id and grade) in one executemany UPDATE,
+# returns the number of grades updated and a list of per-row errors for the rows that were skipped.
+# Only the submitted pairs are looked up, so memory follows the size of the batch, not of the classes in it
+def apply_grades(rows):
+    errors = []
+    parsed = []
+    for number, row in enumerate(rows, start=1):
+        try:
+            student_id, class_id = int(row['student_id']), int(row['class_id'])
+            grade = row['grade']
+        except (KeyError, TypeError, ValueError):
+            errors.append({'row': number, 'error': 'expected integer student_id and class_id and a grade'})
+            continue
+        # a short CSV row or a JSON null would otherwise be saved as the string "None"
+        grade = str(grade).strip() if grade is not None else ''
+        if not grade:
+            errors.append({'row': number, 'error': 'grade is missing'})
+            continue
+        if len(grade) > 4:
+            errors.append({'row': number, 'error': 'grade must be 1 to 4 characters'})
+            continue
+        parsed.append((number, student_id, class_id, grade))
+
+    pairs = list({(student_id, class_id) for _, student_id, class_id, _ in parsed})
+    enrolled = set()
+    connection = db.session.connection()
+    for start in range(0, len(pairs), GRADE_CHECK_CHUNK):
+        chunk = pairs[start:start + GRADE_CHECK_CHUNK]
+        # joined from a VALUES list so SQLite searches the (student_id, class_id) index once per pair
+        enrolled.update(tuple(row) for row in connection.exec_driver_sql(
+            'WITH pairs(student_id, class_id) AS (VALUES ' + ', '.join(['(?, ?)'] * len(chunk)) + ') '
+            'SELECT enrollment.student_id, enrollment.class_id FROM pairs JOIN enrollment '
+            'ON enrollment.student_id = pairs.student_id AND enrollment.class_id = pairs.class_id',
+            tuple(value for pair in chunk for value in pair)))
+    params = []
+    for number, student_id, class_id, grade in parsed:
+        if (student_id, class_id) not in enrolled:
+            errors.append({'row': number, 'error': f'student {student_id} is not enrolled in class {class_id}'})
+            continue
+        params.append({'s_id': student_id, 'c_id': class_id, 'new_grade': grade})
+
+    if params:
+        db.session.execute(
+            update(Enrollment.__table__).
+            where(Enrollment.student_id == bindparam('s_id'), Enrollment.class_id == bindparam('c_id')).
+            values(grade=bindparam('new_grade')), params)
+    db.session.commit()
+    for class_id in {row['c_id'] for row in params}:
+        invalidate_grades(class_id)
+    return len(params), errors
 
 
-@app.route('/change_grade_math101', methods=['GET', 'POST'])
+# bulk grade import, takes a JSON list of {student_id, class_id, grade} objects or a CSV file/body with a
+# student_id,class_id,grade header
+@app.route('/grades/bulk', methods=['POST'])
 @login_required
-def change_grade_math101():
+def bulk_grades():
     if not is_teacher(current_user):
-        redirect(url_for('login'))
-    if request.method == 'POST':
-        fname = request.form['first']
-        lname = request.form['last']
-        student = Students.query.filter(Students.first_name == fname and Students.last_name == lname)
-        grade = request.form['grade']
-        if student.scalar() is not None:
-            record = db.session.query(Enrollment).filter(Enrollment.student_id == student.first().id).\
-                filter(Enrollment.class_id == 1)
-            if record.scalar() is not None:
-                record.first().grade = grade
-                db.session.commit()
-            return redirect(url_for('class_Math101'))
-    return redirect(url_for('login'))
-
-
-@app.route('/user/drop', methods=['POST', 'GET'])
-@login_required
-def drop_user_class():
-    user = Users.query.filter_by(id=current_user.id).first()
-    student = Students.query.filter(Students.user_id == user.id).first()
-    name = student.first_name
-    classes = Classes.query.all()
-    class_names = []
-    times = []
-    enrolled = []
-    cap = []
-    for c in classes:
-        class_names.append(c.class_name)
-        times.append(c.timeslot)
-        enrolled.append(c.enrolled)
-        cap.append(c.size)
-
-    if request.method == 'POST':
-        class_id = int(request.form['drop_button'])
-        selected_class = Classes.query.filter(Classes.id == class_id).first()
-        student = Students.query.filter(Students.user_id == current_user.id).first()
-        if not is_enrolled(class_id, student.id):
-            return render_template(
-                'registration.html', class_names=class_names, times=times, enrolled=enrolled, cap=cap,
-                name=name, classes=classes, teachers=Teachers, error='You are not currently enrolled in this class!')
+        return jsonify(error='You do not have permission to change grades'), 403
+    if request.is_json:
+        rows = request.get_json(silent=True)
+        if not isinstance(rows, list):
+            return jsonify(error='expected a JSON list of grade rows'), 400
+    elif 'file' in request.files:
+        rows = csv.DictReader(io.TextIOWrapper(request.files['file'].stream, encoding='utf-8'))
+    else:
+        rows = csv.DictReader(io.StringIO(request.get_data(as_text=True)))
+    updated, errors = apply_grades(rows)
+    return jsonify(updated=updated, errors=errors)
+
+
+# columns of a gradebook export
+EXPORT_COLUMNS = ['student_id', 'student', 'class_id', 'class_name', 'teacher', 'grade']
+EXPORT_BATCH_SIZE = 1000
+
+
+# stream the gradebook (optionally for a single class) as CSV or NDJSON text chunks, rows are read from the
+# cursor EXPORT_BATCH_SIZE at a time so memory does not grow with the size of the enrollment table
+def export_gradebook(fmt='csv', class_id=None):
+    query = db.session.query(
+        Students.id.label('student_id'), (Students.first_name + ' ' + Students.last_name).label('student'),
+        Classes.id.label('class_id'), Classes.class_name,
+        (Teachers.first_name + ' ' + Teachers.last_name).label('teacher'), Enrollment.grade
+    ).select_from(Enrollment).join(Students, Enrollment.student_id == Students.id).\
+        join(Classes, Enrollment.class_id == Classes.id).join(Teachers, Classes.teacher_id == Teachers.id)
+    if class_id is not None:
+        query = query.filter(Enrollment.class_id == class_id)
+    rows = query.order_by(Enrollment.class_id, Enrollment.id).\
+        execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(EXPORT_COLUMNS)
+    for number, row in enumerate(rows, start=1):
+        if fmt == 'csv':
+            writer.writerow(row)
         else:
-            drop_class(student.id, class_id)
-            return redirect(url_for('registration'))
-        return redirect(url_for('user_page'))
+            buffer.write(json.dumps(row._asdict()) + '\n')
+        if number % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
 
 
-@app.route('/class/phys121', methods=['GET', 'POST'])
-@login_required
-def class_Physics121():
-    if not is_teacher(current_user):
-        flash('You do not have permission to view this page')
-        return redirect(url_for('login'))
-    student_names = []
-    students = []
-    grades = {}
-    course = Classes.query.filter_by(class_name='Physics121').first()
-    enrolled = Enrollment.query.filter(Enrollment.class_id == course.id)
-    for student in course.students:
-        student_names.append(student.first_name + " " + student.last_name)
-        students.append(student)
-    for x in enrolled:
-        for y in students:
-            if y.id == x.student_id:
-                name = y.first_name + ' ' + y.last_name
-                grades[name] = x.grade
-    return render_template('Physics121.html', students=student_names, grades=grades)
-
-
-@app.route('/change_grade_phys121', methods=['GET', 'POST'])
+@app.route('/export/gradebook')
 @login_required
-def change_grade_phys121():
+def export_gradebook_view():
     if not is_teacher(current_user):
-        redirect(url_for('login'))
-    if request.method == 'POST':
-        fname = request.form['first']
-        lname = request.form['last']
-        student = Students.query.filter(Students.first_name == fname and Students.last_name == lname)
-        grade = request.form['grade']
-        if student.scalar() is not None:
-            record = db.session.query(Enrollment).filter(Enrollment.student_id == student.first().id).\
-                filter(Enrollment.class_id == 2)
-            if record.scalar() is not None:
-                record.first().grade = grade
-                db.session.commit()
-            return redirect(url_for('class_Physics121'))
-    return redirect(url_for('login'))
+        return jsonify(error='You do not have permission to export grades'), 403
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify(error='format must be csv or ndjson'), 400
+    class_id = request.args.get('class_id', type=int)
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(export_gradebook(fmt, class_id)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=gradebook.{fmt}'})
+
+
+# synthetic data for load testing, every generated user logs in with GENERATED_PASSWORD
+GENERATED_PASSWORD = 'password'
+GENERATED_BATCH_SIZE = 10000
+
+
+def generated_timeslots():
+    timeslots = []
+    for days in ('MWF', 'TR', 'MW'):
+        for hour in range(8, 17):
+            clock = hour if hour <= 12 else hour - 12
+            timeslots.append(f'{days} {clock}:00-{clock}:50 {"AM" if hour < 12 else "PM"}')
+    return timeslots
+
+
+# bulk insert users, teachers, students, classes (with their meetings) and enrollments, ids continue after the
+# rows already in the database so the generator can be run on top of existing data
+def generate_data(students, classes, teachers, classes_per_student, seed=0):
+    rng = random.Random(seed)
+    password = hash_password(GENERATED_PASSWORD)
+    timeslots = generated_timeslots()
+
+    def next_id(model):
+        return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+    def insert(model, rows):
+        for start in range(0, len(rows), GENERATED_BATCH_SIZE):
+            db.session.execute(model.__table__.insert(), rows[start:start + GENERATED_BATCH_SIZE])
+
+    user_id, teacher_id, student_id, class_id = next_id(Users), next_id(Teachers), next_id(Students), next_id(Classes)
+    users = []
+    teacher_rows = []
+    student_rows = []
+    for n in range(teachers):
+        users.append({'id': user_id, 'username': f'teacher{teacher_id + n}', 'password': password})
+        teacher_rows.append({'id': teacher_id + n, 'first_name': 'Teacher', 'last_name': str(teacher_id + n),
+                             'user_id': user_id})
+        user_id += 1
+    for n in range(students):
+        users.append({'id': user_id, 'username': f'student{student_id + n}', 'password': password})
+        student_rows.append({'id': student_id + n, 'first_name': 'Student', 'last_name': str(student_id + n),
+                             'user_id': user_id})
+        user_id += 1
+
+    class_ids = list(range(class_id, class_id + classes))
+    enrollments = []
+    counts = dict.fromkeys(class_ids, 0)
+    for student in student_rows:
+        for course in rng.sample(class_ids, min(classes_per_student, classes)):
+            enrollments.append({'class_id': course, 'student_id': student['id'], 'grade': str(rng.randint(50, 100))})
+            counts[course] += 1
+    # enrolled starts at zero, the enrollment triggers count the inserted rows
+    class_rows = []
+    meeting_rows = []
+    for course in class_ids:
+        timeslot = rng.choice(timeslots)
+        class_rows.append({'id': course, 'class_name': f'Course{course}', 'timeslot': timeslot,
+                           'size': counts[course] + rng.randint(0, 10), 'enrolled': 0,
+                           'teacher_id': teacher_id + rng.randrange(teachers)})
+        meeting_rows.extend({'class_id': course, 'day': day, 'start_minute': start, 'end_minute': end}
+                            for day, start, end in parse_timeslot(timeslot))
+
+    insert(Users, users)
+    insert(Teachers, teacher_rows)
+    insert(Students, student_rows)
+    insert(Classes, class_rows)
+    insert(ClassMeeting, meeting_rows)
+    insert(Enrollment, enrollments)
+    db.session.commit()
+    catalog_cache.clear()
+    return len(users) + len(teacher_rows) + len(student_rows) + len(class_rows) + len(enrollments)
+
+
+# term setup import: one CSV per table whose header holds the model column names listed in IMPORT_COLUMNS
+# (enrollments may add a grade column). Rows carry their own ids, so every foreign key is checked in memory
+# against the database and the other files before anything is written, and rows whose id (or student/class
+# pair) is already in the database are skipped. An import that failed half way is resumed by running it again
+IMPORT_TABLES = ('users', 'teachers', 'students', 'classes', 'enrollments')
+IMPORT_COLUMNS = {
+    'users': ('id', 'username', 'password'),
+    'teachers': ('id', 'first_name', 'last_name', 'user_id'),
+    'students': ('id', 'first_name', 'last_name', 'user_id'),
+    'classes': ('id', 'class_name', 'timeslot', 'size', 'teacher_id'),
+    'enrollments': ('student_id', 'class_id'),
+}
+IMPORT_BATCH_SIZE = 5000
+
+
+# check the CSV files given as {table: path}, returns the rows to insert per table, the number of rows already
+# in the database per table and a list of error messages
+def validate_import(files):
+    rows = {table: [] for table in IMPORT_TABLES}
+    skipped = dict.fromkeys(IMPORT_TABLES, 0)
+    errors = []
+
+    def read(table):
+        if not files.get(table):
+            return []
+        with open(files[table], newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            missing = [column for column in IMPORT_COLUMNS[table] if column not in (reader.fieldnames or [])]
+            if missing:
+                errors.append(f'{files[table]}: missing columns {", ".join(missing)}')
+                return []
+            return [(number, {key: (value or '').strip() for key, value in row.items() if key})
+                    for number, row in enumerate(reader, start=2)]
+
+    def error(table, number, message):
+        errors.append(f'{files[table]}:{number}: {message}')
+
+    def integers(table, number, row, *columns):
+        try:
+            return [int(row[column]) for column in columns]
+        except ValueError:
+            error(table, number, f'{", ".join(columns)} must be integers')
+            return None
+
+    usernames = dict(db.session.query(Users.username, Users.id))
+    user_ids = set(usernames.values())
+    profile_users = {user_id for (user_id,) in db.session.query(Teachers.user_id)} | \
+                    {user_id for (user_id,) in db.session.query(Students.user_id)}
+    teacher_ids = {teacher_id for (teacher_id,) in db.session.query(Teachers.id)}
+    student_ids = {student_id for (student_id,) in db.session.query(Students.id)}
+    seats = {class_id: size - enrolled for class_id, size, enrolled in
+             db.session.query(Classes.id, Classes.size, Classes.enrolled)}
+    enrolled = set(db.session.query(Enrollment.student_id, Enrollment.class_id))
+
+    for number, row in read('users'):
+        ids = integers('users', number, row, 'id')
+        if ids is None:
+            continue
+        user_id, username = ids[0], row['username']
+        if user_id in user_ids:
+            if usernames.get(username) == user_id:
+                skipped['users'] += 1
+            else:
+                error('users', number, f'user {user_id} already exists with another username')
+        elif not 0 < len(username) <= 25 or not row['password']:
+            error('users', number, 'username must be 1 to 25 characters and password must be set')
+        elif username in usernames:
+            error('users', number, f'username {username} is taken')
+        else:
+            user_ids.add(user_id)
+            usernames[username] = user_id
+            rows['users'].append({'id': user_id, 'username': username, 'password': row['password']})
+
+    for table, profile_ids in (('teachers', teacher_ids), ('students', student_ids)):
+        for number, row in read(table):
+            ids = integers(table, number, row, 'id', 'user_id')
+            if ids is None:
+                continue
+            profile_id, user_id = ids
+            if profile_id in profile_ids:
+                skipped[table] += 1
+            elif not 0 < len(row['first_name']) <= 25 or not 0 < len(row['last_name']) <= 25:
+                error(table, number, 'first_name and last_name must be 1 to 25 characters')
+            elif user_id not in user_ids:
+                error(table, number, f'user {user_id} does not exist')
+            elif user_id in profile_users:
+                error(table, number, f'user {user_id} already has a teacher or student profile')
+            else:
+                profile_ids.add(profile_id)
+                profile_users.add(user_id)
+                rows[table].append({'id': profile_id, 'first_name': row['first_name'], 'last_name': row['last_name'],
+                                    'user_id': user_id})
+
+    for number, row in read('classes'):
+        ids = integers('classes', number, row, 'id', 'size', 'teacher_id')
+        if ids is None:
+            continue
+        class_id, size, teacher_id = ids
+        if class_id in seats:
+            skipped['classes'] += 1
+            continue
+        try:
+            parse_timeslot(row['timeslot'])
+        except ValueError as e:
+            error('classes', number, str(e))
+            continue
+        if not 0 < len(row['class_name']) <= 100 or size < 0:
+            error('classes', number, 'class_name must be 1 to 100 characters and size must not be negative')
+        elif teacher_id not in teacher_ids:
+            error('classes', number, f'teacher {teacher_id} does not exist')
+        else:
+            seats[class_id] = size
+            rows['classes'].append({'id': class_id, 'class_name': row['class_name'], 'timeslot': row['timeslot'],
+                                    'size': size, 'enrolled': 0, 'teacher_id': teacher_id})
+
+    for number, row in read('enrollments'):
+        ids = integers('enrollments', number, row, 'student_id', 'class_id')
+        if ids is None:
+            continue
+        student_id, class_id = ids
+        grade = row.get('grade') or '100'
+        if (student_id, class_id) in enrolled:
+            skipped['enrollments'] += 1
+        elif len(grade) > 4:
+            error('enrollments', number, 'grade must be 1 to 4 characters')
+        elif student_id not in student_ids:
+            error('enrollments', number, f'student {student_id} does not exist')
+        elif class_id not in seats:
+            error('enrollments', number, f'class {class_id} does not exist')
+        elif seats[class_id] <= 0:
+            error('enrollments', number, f'class {class_id} is full')
+        else:
+            seats[class_id] -= 1
+            enrolled.add((student_id, class_id))
+            rows['enrollments'].append({'student_id': student_id, 'class_id': class_id, 'grade': grade})
+    return rows, skipped, errors
+
+
+# insert validated rows, each batch in its own transaction so a failure keeps the batches already committed.
+# Passwords are hashed per batch on a thread pool (the KDFs release the GIL). The fast mode turns off fsync and
+# foreign key enforcement on the loading connection, the rows have been checked already. Returns
+# {table: (rows inserted, seconds)}
+def load_import(rows, batch_size=IMPORT_BATCH_SIZE, fast=False):
+    tables = {'users': Users, 'teachers': Teachers, 'students': Students, 'classes': Classes,
+              'enrollments': Enrollment}
+    stats = {}
+    with db.engine.connect() as connection, ThreadPoolExecutor() as executor:
+        if fast:
+            connection.exec_driver_sql('PRAGMA synchronous=OFF')
+            connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
+            connection.exec_driver_sql('PRAGMA temp_store=MEMORY')
+        try:
+            for table in IMPORT_TABLES:
+                started = time.perf_counter()
+                for start in range(0, len(rows[table]), batch_size):
+                    batch = rows[table][start:start + batch_size]
+                    if table == 'users':
+                        passwords = executor.map(
+                            lambda password: password if is_password_hash(password) else hash_password(password),
+                            [row['password'] for row in batch])
+                        batch = [dict(row, password=password) for row, password in zip(batch, passwords)]
+                    with connection.begin():
+                        connection.execute(tables[table].__table__.insert(), batch)
+                        if table == 'classes':
+                            connection.execute(ClassMeeting.__table__.insert(), [
+                                {'class_id': row['id'], 'day': day, 'start_minute': start_minute, 'end_minute': end_minute}
+                                for row in batch
+                                for day, start_minute, end_minute in parse_timeslot(row['timeslot'])])
+                stats[table] = (len(rows[table]), time.perf_counter() - started)
+        finally:
+            if fast:
+                connection.exec_driver_sql(f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}")
+                connection.exec_driver_sql('PRAGMA foreign_keys=ON')
+                connection.exec_driver_sql('PRAGMA temp_store=DEFAULT')
+        connection.exec_driver_sql('ANALYZE')
+    catalog_cache.clear()
+    return stats
+
+
+# rows per /grades/bulk request timed by run_benchmark
+BENCHMARK_GRADE_ROWS = 1000
+
+
+# drive the app through the test client as a sample of generated users and report latency percentiles,
+# queries per request and throughput for each route. Has to run outside an app context, otherwise every
+# request would share the same flask.g (and the logged in user with it)
+def run_benchmark(requests_per_route=100, users=20, seed=0):
+    rng = random.Random(seed)
+    with app.app_context():
+        student_names = [name for (name,) in db.session.query(Users.username).join(
+            Students, Students.user_id == Users.id).filter(Users.username.like('student%')).limit(1000)]
+        teacher_names = [name for (name,) in db.session.query(Users.username).join(
+            Teachers, Teachers.user_id == Users.id).filter(Users.username.like('teacher%')).limit(1000)]
+        class_ids = [class_id for (class_id,) in db.session.query(Classes.id).limit(1000)]
+        max_enrollment = db.session.query(db.func.max(Enrollment.id)).scalar() or 0
+    if not student_names or not teacher_names:
+        raise click.ClickException('No generated users found, run `flask generate-data` first')
+
+    queries = [0]
+
+    def count_query(*args):
+        queries[0] += 1
+
+    def logged_in(username):
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': GENERATED_PASSWORD})
+        return client
+
+    students = [logged_in(name) for name in rng.sample(student_names, min(users, len(student_names)))]
+    teachers = [logged_in(name) for name in rng.sample(teacher_names, min(users, len(teacher_names)))]
+    routes = {
+        'user_page': (students, lambda: '/user/classes'),
+        'registration': (students, lambda: '/user/registration'),
+        'teacher_page': (teachers, lambda: '/teacher'),
+        'class_roster': (teachers, lambda: f'/class/{rng.choice(class_ids)}'),
+        'admin_enrollment': (teachers, lambda: '/admin/enrollment/'),
+    }
+    results = {}
+    event.listen(Engine, 'before_cursor_execute', count_query)
+    try:
+        for route, (clients, url) in routes.items():
+            latencies = []
+            queries[0] = 0
+            started = time.perf_counter()
+            for n in range(requests_per_route):
+                request_started = time.perf_counter()
+                response = clients[n % len(clients)].get(url())
+                latencies.append(time.perf_counter() - request_started)
+                if response.status_code != 200:
+                    raise click.ClickException(f'{route} returned {response.status_code}')
+            elapsed = time.perf_counter() - started
+            latencies.sort()
+            results[route] = {
+                'p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+                'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+                'queries_per_request': round(queries[0] / requests_per_route, 2),
+                'requests_per_second': round(requests_per_route / elapsed, 1),
+            }
+
+        # bulk grade import: batches of graded enrollments posted back with their current grade, so the run
+        # does not change the data
+        batches = max(requests_per_route // 10, 1)
+        with app.app_context():
+            ids = [rng.randint(1, max_enrollment) for _ in range(batches * BENCHMARK_GRADE_ROWS)]
+            graded = [{'student_id': student_id, 'class_id': class_id, 'grade': grade}
+                      for student_id, class_id, grade in db.session.query(
+                          Enrollment.student_id, Enrollment.class_id, Enrollment.grade).
+                      filter(Enrollment.id.in_(ids), Enrollment.grade.isnot(None))]
+        if graded:
+            latencies = []
+            queries[0] = rows = 0
+            started = time.perf_counter()
+            for n in range(batches):
+                batch = graded[n * BENCHMARK_GRADE_ROWS:(n + 1) * BENCHMARK_GRADE_ROWS] or graded
+                rows += len(batch)
+                request_started = time.perf_counter()
+                response = teachers[n % len(teachers)].post('/grades/bulk', json=batch)
+                latencies.append(time.perf_counter() - request_started)
+                if response.status_code != 200 or response.get_json()['errors']:
+                    raise click.ClickException(f'grades_bulk returned {response.status_code}')
+            elapsed = time.perf_counter() - started
+            latencies.sort()
+            results['grades_bulk'] = {
+                'p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+                'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+                'queries_per_request': round(queries[0] / batches, 2),
+                'requests_per_second': round(batches / elapsed, 1),
+                'rows_per_second': round(rows / elapsed, 1),
+            }
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count_query)
+    return results
+
+
+# the last run recorded in a benchmark results file, None if there is none
+def last_benchmark_run(output):
+    if not os.path.exists(output):
+        return None
+    with open(output) as f:
+        lines = [line for line in f if line.strip()]
+    return json.loads(lines[-1]) if lines else None
+
+
+def p50_change(stats, previous, section, name):
+    before = previous and previous.get(section, {}).get(name)
+    if not before or not before['p50_ms']:
+        return ''
+    return f'  p50 {(stats["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100:+.0f}% vs {previous["commit"]}'
+
+
+def record_benchmark_run(output, section, results):
+    with open(output, 'a') as f:
+        f.write(json.dumps({'commit': current_commit(), 'time': int(time.time()), section: results}) + '\n')
+
+
+# lookups timed per index by run_lookup_benchmark
+LOOKUP_SAMPLES = 1000
+
+
+# time the single-row lookups behind every request: a profile by user_id (load_user, is_teacher) and an
+# enrollment by (student_id, class_id) (is_enrolled). The database is first filled up to `students` generated
+# students. Returns {lookup: {p50_ms, p99_ms, plan}}, plan being SQLite's query plan so a missing index shows
+def run_lookup_benchmark(students=100000, samples=LOOKUP_SAMPLES, seed=0):
+    existing = db.session.query(db.func.count(Students.id)).scalar()
+    if existing < students:
+        missing = students - existing
+        generate_data(missing, max(missing // 50, 1), max(missing // 500, 1), 4, seed)
+    rng = random.Random(seed)
+    student_users = [user_id for (user_id,) in db.session.query(Students.user_id)]
+    teacher_users = [user_id for (user_id,) in db.session.query(Teachers.user_id)]
+    max_enrollment = db.session.query(db.func.max(Enrollment.id)).scalar() or 0
+    pairs = db.session.query(Enrollment.student_id, Enrollment.class_id).filter(
+        Enrollment.id.in_([rng.randint(1, max_enrollment) for _ in range(samples)])).all()
+    if not student_users or not teacher_users or not pairs:
+        raise click.ClickException('The database has no students, teachers or enrollments to look up')
+
+    lookups = {
+        'student_by_user_id': (lambda user_id: db.session.query(Students.id).filter(Students.user_id == user_id),
+                               lambda: (rng.choice(student_users),)),
+        'teacher_by_user_id': (lambda user_id: db.session.query(Teachers.id).filter(Teachers.user_id == user_id),
+                               lambda: (rng.choice(teacher_users),)),
+        'enrollment_by_student_class': (
+            lambda student_id, class_id: db.session.query(Enrollment.id).filter(
+                Enrollment.student_id == student_id, Enrollment.class_id == class_id),
+            lambda: rng.choice(pairs)),
+    }
+    results = {}
+    for name, (query, arguments) in lookups.items():
+        sample = query(*arguments())
+        statement = sample.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+        plan = '; '.join(row[-1] for row in db.session.execute(db.text(f'EXPLAIN QUERY PLAN {statement}')))
+        latencies = []
+        for _ in range(samples):
+            lookup = query(*arguments())
+            started = time.perf_counter()
+            lookup.first()
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        results[name] = {
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000, 4),
+            'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 4),
+            'plan': plan,
+        }
+    return results
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=basedir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# WSGI entry point for production servers, e.g. gunicorn 'backend:create_app()'. This is not an application
+# factory: it applies the config overrides to the module-level app, gives it a fresh catalog cache and returns
+# that same app, so every call configures the one app object. Nothing here touches the database, the schema is
+# created separately with `flask init-db`
+def create_app(config=None):
+    if config:
+        app.config.update(config)
+    set_catalog_cache(TTLCache(app.config['CATALOG_CACHE_SIZE'], app.config['CATALOG_CACHE_TTL']))
+    return app
+
+
+# ASGI entry point, needs asgiref, e.g. uvicorn --factory 'backend:create_asgi_app'
+def create_asgi_app(config=None):
+    from asgiref.wsgi import WsgiToAsgi
+    return WsgiToAsgi(create_app(config))
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the tables and indexes and upgrade an existing database."""
+    migrate_db()
+    click.echo('Database initialized')
+
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Upgrade an existing database to the current schema and indexes."""
+    duplicates = migrate_db()
+    click.echo(f'Database migrated, {duplicates} duplicate enrollments removed')
+
+
+@app.cli.command('reconcile-stats')
+def reconcile_stats_command():
+    """Rebuild the enrolled counters and grade statistics of every class from the enrollments."""
+    started = time.perf_counter()
+    reconcile_stats()
+    click.echo(f'Class statistics rebuilt in {time.perf_counter() - started:.2f} s')
+
+
+@app.cli.command('calibrate-password-hash')
+@click.option('--hasher', type=click.Choice(PASSWORD_HASHERS), default=None)
+@click.option('--target-ms', type=int, default=None, help='Time one password hash should take on this host.')
+def calibrate_password_hash_command(hasher, target_ms):
+    """Find the hashing cost that takes about the target time on this host."""
+    hasher = hasher or app.config['PASSWORD_HASHER']
+    target = (target_ms or app.config['PASSWORD_HASH_TARGET_MS']) / 1000
+
+    def measure(cost):
+        start = time.perf_counter()
+        derive_key(hasher, cost, 'calibration password', 'calibration salt')
+        return time.perf_counter() - start
+
+    if hasher == 'scrypt':
+        # n has to be a power of two, keep doubling while the next step is closer to the target
+        cost, elapsed = 2 ** 10, measure(2 ** 10)
+        while elapsed < target and abs(measure(cost * 2) - target) < abs(elapsed - target):
+            cost *= 2
+            elapsed = measure(cost)
+        setting = 'PASSWORD_SCRYPT_N'
+    else:
+        cost = 10000
+        elapsed = measure(cost)
+        cost = max(int(cost * target / elapsed), 1000)
+        elapsed = measure(cost)
+        setting = 'PASSWORD_PBKDF2_ITERATIONS'
+    click.echo(f'PASSWORD_HASHER={hasher} {setting}={cost} ({elapsed * 1000:.0f} ms per hash)')
+
+
+@app.cli.command('export-gradebook')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default='csv')
+@click.option('--class-id', type=int, default=None, help='Only export this class.')
+@click.option('--output', type=click.File('w'), default='-', help='File to write to, stdout by default.')
+def export_gradebook_command(fmt, class_id, output):
+    """Stream the gradebook of every course as CSV or NDJSON."""
+    for chunk in export_gradebook(fmt, class_id):
+        output.write(chunk)
+
+
+@app.cli.command('generate-data')
+@click.option('--students', type=int, default=1000)
+@click.option('--classes', type=int, default=50)
+@click.option('--teachers', type=int, default=20)
+@click.option('--classes-per-student', type=int, default=4)
+@click.option('--seed', type=int, default=0)
+def generate_data_command(students, classes, teachers, classes_per_student, seed):
+    """Fill the database with synthetic users, students, teachers, classes and enrollments."""
+    started = time.perf_counter()
+    rows = generate_data(students, classes, teachers, classes_per_student, seed)
+    elapsed = time.perf_counter() - started
+    click.echo(f'Inserted {rows} rows in {elapsed:.1f} s ({rows / elapsed:.0f} rows/s)')
+
+
+@app.cli.command('import-term')
+@click.option('--users', type=click.Path(exists=True, dir_okay=False), help='CSV with id,username,password.')
+@click.option('--teachers', type=click.Path(exists=True, dir_okay=False),
+              help='CSV with id,first_name,last_name,user_id.')
+@click.option('--students', type=click.Path(exists=True, dir_okay=False),
+              help='CSV with id,first_name,last_name,user_id.')
+@click.option('--classes', type=click.Path(exists=True, dir_okay=False),
+              help='CSV with id,class_name,timeslot,size,teacher_id.')
+@click.option('--enrollments', type=click.Path(exists=True, dir_okay=False),
+              help='CSV with student_id,class_id and an optional grade.')
+@click.option('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='Rows per transaction.')
+@click.option('--fast', is_flag=True, help='Load without fsync and foreign key enforcement.')
+def import_term_command(users, teachers, students, classes, enrollments, batch_size, fast):
+    """Bulk load users, teachers, students, classes and enrollments from CSV files. Nothing is written unless
+    every row is valid, and rows already in the database are skipped, so a failed import can be run again."""
+    files = {'users': users, 'teachers': teachers, 'students': students, 'classes': classes,
+             'enrollments': enrollments}
+    if not any(files.values()):
+        raise click.UsageError('Give at least one CSV file to import')
+    started = time.perf_counter()
+    rows, skipped, errors = validate_import(files)
+    if errors:
+        for message in errors[:50]:
+            click.echo(message, err=True)
+        raise click.ClickException(f'{len(errors)} problems found, nothing was imported')
+    click.echo(f'Validated in {time.perf_counter() - started:.1f} s')
+    stats = load_import(rows, batch_size, fast)
+    for table in IMPORT_TABLES:
+        if files[table]:
+            inserted, elapsed = stats[table]
+            click.echo(f'{table:12} {inserted:9d} inserted {skipped[table]:9d} already loaded  '
+                       f'{inserted / elapsed if elapsed else 0:9.0f} rows/s')
+    total = sum(inserted for inserted, _ in stats.values())
+    elapsed = time.perf_counter() - started
+    click.echo(f'Imported {total} rows in {elapsed:.1f} s ({total / elapsed:.0f} rows/s)')
+
+
+@app.cli.command('benchmark')
+@click.option('--requests', 'requests_per_route', type=int, default=100, help='Requests per route.')
+@click.option('--users', type=int, default=20, help='Generated users to spread the requests over.')
+@click.option('--output', default=os.path.join(basedir, 'bench_results.jsonl'),
+              help='File the results are appended to, one JSON line per run.')
+def benchmark_command(requests_per_route, users, output):
+    """Measure latency, queries per request and throughput per route and compare with the last run."""
+    # the CLI runs commands inside an app context, a new thread starts without it
+    results = {}
+    worker = threading.Thread(target=lambda: results.update(run_benchmark(requests_per_route, users)))
+    worker.start()
+    worker.join()
+    if not results:
+        raise click.ClickException('Benchmark failed')
+    previous = last_benchmark_run(output)
+    for route, stats in results.items():
+        line = (f'{route:18} p50 {stats["p50_ms"]:8.2f} ms  p99 {stats["p99_ms"]:8.2f} ms  '
+                f'{stats["queries_per_request"]:6.2f} queries  {stats["requests_per_second"]:8.1f} req/s')
+        if 'rows_per_second' in stats:
+            line += f'  {stats["rows_per_second"]:9.0f} rows/s'
+        click.echo(line + p50_change(stats, previous, 'routes', route))
+    record_benchmark_run(output, 'routes', results)
+
+
+@app.cli.command('benchmark-lookups')
+@click.option('--students', type=int, default=100000, help='Students the database is filled up to first.')
+@click.option('--samples', type=int, default=LOOKUP_SAMPLES, help='Lookups timed per index.')
+@click.option('--output', default=os.path.join(basedir, 'bench_lookups.jsonl'),
+              help='File the results are appended to, one JSON line per run.')
+def benchmark_lookups_command(students, samples, output):
+    """Time the indexed user_id and enrollment lookups on a database with the given number of students."""
+    results = run_lookup_benchmark(students, samples)
+    previous = last_benchmark_run(output)
+    for lookup, stats in results.items():
+        line = f'{lookup:28} p50 {stats["p50_ms"]:8.3f} ms  p99 {stats["p99_ms"]:8.3f} ms  {stats["plan"]}'
+        click.echo(line + p50_change(stats, previous, 'lookups', lookup))
+    record_benchmark_run(output, 'lookups', results)
+
+
+@app.cli.command('serve')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', type=int, default=8000)
+@click.option('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes (gunicorn only).')
+@click.option('--threads', type=int, default=4, help='Threads per worker.')
+def serve_command(host, port, workers, threads):
+    """Run the app with a production server, gunicorn if it is installed, otherwise waitress."""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        BaseApplication = None
+
+    if BaseApplication is not None:
+        app.config['SINGLE_PROCESS'] = workers == 1
+
+        class Server(BaseApplication):
+            def load_config(self):
+                self.cfg.set('bind', f'{host}:{port}')
+                self.cfg.set('workers', workers)
+                self.cfg.set('threads', threads)
+
+            def load(self):
+                return create_app()
+
+        Server().run()
+        return
+
+    try:
+        from waitress import serve
+    except ImportError:
+        raise click.ClickException('flask serve needs gunicorn or waitress to be installed')
+    app.config['SINGLE_PROCESS'] = True
+    serve(create_app(), host=host, port=port, threads=threads)
+
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # development server only, use `flask serve` in production
+    app.config['SINGLE_PROCESS'] = True
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1')
@@ -0,0 +1,64 @@
+import os
+import tempfile
+
+import pytest
+
+# backend reads its settings when it is imported, so the test database and a cheap password hash are set first
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.sqlite')
+os.environ['PASSWORD_PBKDF2_ITERATIONS'] = '1000'
+
+import backend  # noqa: E402
+
+PASSWORD = 'password'
+
+
+# a fresh database built with create_all for every test. No app context is kept open while the test runs,
+# otherwise test client requests would share flask.g
+@pytest.fixture
+def app():
+    with backend.app.app_context():
+        backend.db.drop_all()
+        backend.db.create_all()
+    backend.catalog_cache.clear()
+    yield backend.app
+    with backend.app.app_context():
+        backend.db.session.remove()
+
+
+def add_user(model, username, last_name):
+    with backend.app.app_context():
+        user = backend.Users(username=username, password=backend.hash_password(PASSWORD))
+        backend.db.session.add(user)
+        backend.db.session.flush()
+        profile = model(first_name='Test', last_name=last_name, user_id=user.id)
+        backend.db.session.add(profile)
+        backend.db.session.commit()
+        return profile.id
+
+
+# classes taught by teacher_id that do not overlap each other, returns their ids
+def add_classes(teacher_id, count, size=30, first=0):
+    with backend.app.app_context():
+        courses = []
+        for n in range(first, first + count):
+            days = ('M', 'T', 'W', 'R', 'F')[n // 12 % 5]
+            hour = 8 + n % 12
+            courses.append(backend.Classes(class_name=f'Course{n}', timeslot=f'{days} {hour}:00-{hour}:50',
+                                           size=size, teacher_id=teacher_id))
+        backend.db.session.add_all(courses)
+        backend.db.session.commit()
+        return [course.id for course in courses]
+
+
+def enroll(student_id, class_ids):
+    with backend.app.app_context():
+        backend.db.session.add_all([backend.Enrollment(student_id=student_id, class_id=class_id, grade='90')
+                                    for class_id in class_ids])
+        backend.db.session.commit()
+
+
+def login(username):
+    client = backend.app.test_client()
+    response = client.post('/login', data={'username': username, 'password': PASSWORD})
+    assert response.status_code == 302
+    return client
@@ -0,0 +1,49 @@
+import backend
+from conftest import add_classes, add_user, enroll, login
+
+
+def cached(key):
+    return backend.catalog_cache.get(key) is not None
+
+
+def warm_cache(student_id, teacher_ids):
+    with backend.app.app_context():
+        backend.get_catalog()
+        backend.get_schedule_index(student_id)
+        for teacher_id in teacher_ids:
+            backend.get_version('teacher', teacher_id)
+
+
+def edit_class(client, class_id, teacher_id, timeslot):
+    response = client.post(f'/admin/classes/edit/?id={class_id}', data={
+        'class_name': 'Renamed', 'timeslot': timeslot, 'size': '30', 'classes': str(teacher_id)})
+    assert response.status_code == 302
+
+
+# a class edit that keeps the timeslot leaves the schedule indexes cached, a timeslot change drops those of the
+# class's students, and moving the class to another teacher changes both teachers' pages
+def test_class_edit_invalidates_only_what_changed(app):
+    teacher_id = add_user(backend.Teachers, 'teacher', 'Teacher')
+    other_id = add_user(backend.Teachers, 'other', 'Other')
+    class_id = add_classes(teacher_id, 1)[0]
+    student_id = add_user(backend.Students, 'student', 'Student')
+    enroll(student_id, [class_id])
+    client = login('teacher')
+    with backend.app.app_context():
+        timeslot = backend.db.session.get(backend.Classes, class_id).timeslot
+
+    warm_cache(student_id, [teacher_id, other_id])
+    edit_class(client, class_id, teacher_id, timeslot)
+    assert not cached('catalog')
+    assert cached(f'schedule:{student_id}')
+    assert not cached(f'version:teacher:{teacher_id}')
+    assert cached(f'version:teacher:{other_id}')
+
+    warm_cache(student_id, [teacher_id, other_id])
+    edit_class(client, class_id, other_id, 'F 7:00-7:50')
+    with backend.app.app_context():
+        assert backend.db.session.get(backend.Classes, class_id).teacher_id == other_id
+    assert not cached('catalog')
+    assert not cached(f'schedule:{student_id}')
+    assert not cached(f'version:teacher:{teacher_id}')
+    assert not cached(f'version:teacher:{other_id}')
@@ -0,0 +1,48 @@
+import pytest
+
+import backend
+from conftest import add_classes, add_user, enroll, login
+
+
+def grade_of(student_id, class_id):
+    with backend.app.app_context():
+        return backend.Enrollment.query.filter_by(student_id=student_id, class_id=class_id).one().grade
+
+
+# a row without a grade (a short CSV row or a JSON null) is reported and leaves the stored grade alone
+@pytest.mark.parametrize('post', [
+    lambda client, student_id, class_id: client.post(
+        '/grades/bulk', data=f'student_id,class_id,grade\n{student_id},{class_id}\n', content_type='text/csv'),
+    lambda client, student_id, class_id: client.post(
+        '/grades/bulk', json=[{'student_id': student_id, 'class_id': class_id, 'grade': None}]),
+    lambda client, student_id, class_id: client.post(
+        '/grades/bulk', json=[{'student_id': student_id, 'class_id': class_id, 'grade': '  '}]),
+], ids=['csv', 'json', 'blank'])
+def test_missing_grade_is_rejected(app, post):
+    teacher_id = add_user(backend.Teachers, 'teacher', 'Teacher')
+    class_id = add_classes(teacher_id, 1)[0]
+    student_id = add_user(backend.Students, 'student', 'Student')
+    enroll(student_id, [class_id])
+
+    response = post(login('teacher'), student_id, class_id)
+
+    assert response.status_code == 200
+    assert response.get_json() == {'updated': 0, 'errors': [{'row': 1, 'error': 'grade is missing'}]}
+    assert grade_of(student_id, class_id) == '90'
+
+
+# only the submitted pairs are checked: enrolled rows are updated, the others are reported per row
+def test_grades_for_submitted_pairs(app):
+    teacher_id = add_user(backend.Teachers, 'teacher', 'Teacher')
+    class_ids = add_classes(teacher_id, 2)
+    student_id = add_user(backend.Students, 'student', 'Student')
+    enroll(student_id, class_ids[:1])
+
+    response = login('teacher').post('/grades/bulk', json=[
+        {'student_id': student_id, 'class_id': class_ids[0], 'grade': 'A'},
+        {'student_id': student_id, 'class_id': class_ids[1], 'grade': 'B'},
+    ])
+
+    assert response.get_json() == {'updated': 1, 'errors': [
+        {'row': 2, 'error': f'student {student_id} is not enrolled in class {class_ids[1]}'}]}
+    assert grade_of(student_id, class_ids[0]) == 'A'
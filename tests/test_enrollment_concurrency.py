@@ -0,0 +1,37 @@
+import threading
+
+import backend
+from conftest import add_classes, add_user
+
+THREADS = 60
+SEATS = 3
+
+
+# many students racing for the last seats of a class on separate threads and pooled connections, exactly
+# SEATS of them get in and the counter matches the enrollment rows
+def test_concurrent_add_class_never_overfills(app):
+    teacher_id = add_user(backend.Teachers, 'teacher', 'Teacher')
+    class_id = add_classes(teacher_id, 1, size=SEATS)[0]
+    student_ids = [add_user(backend.Students, f'student{n}', str(n)) for n in range(THREADS)]
+
+    results = []
+    start = threading.Barrier(THREADS)
+
+    def register(student_id):
+        with app.app_context():
+            start.wait()
+            results.append(backend.add_class(student_id, class_id))
+            backend.db.session.remove()
+
+    threads = [threading.Thread(target=register, args=(student_id,)) for student_id in student_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == THREADS
+    assert results.count(backend.ENROLLED) == SEATS
+    assert results.count(backend.CLASS_FULL) == THREADS - SEATS
+    with app.app_context():
+        assert backend.db.session.get(backend.Classes, class_id).enrolled == SEATS
+        assert backend.Enrollment.query.filter_by(class_id=class_id).count() == SEATS
@@ -0,0 +1,39 @@
+import pytest
+
+import backend
+from conftest import PASSWORD, add_user
+
+
+def post_login(username, password=PASSWORD):
+    return backend.app.test_client().post('/login', data={'username': username, 'password': password})
+
+
+# an unknown username goes through the key derivation like a wrong password, with the current cost settings
+def test_unknown_username_derives_a_key(app, monkeypatch):
+    add_user(backend.Students, 'student', 'Student')
+    # the dummy hash is made on first use
+    with backend.app.app_context():
+        backend.dummy_password_hash()
+    calls = []
+    derive_key = backend.derive_key
+    monkeypatch.setattr(backend, 'derive_key', lambda *args: calls.append(args[:2]) or derive_key(*args))
+
+    for username, password in (('student', 'wrong'), ('nobody', PASSWORD)):
+        calls.clear()
+        response = post_login(username, password)
+        assert response.status_code == 200
+        assert b'Invalid username or password' in response.data
+        assert calls == [('pbkdf2_sha256', backend.app.config['PASSWORD_PBKDF2_ITERATIONS'])]
+
+
+# a stored hash that can't be parsed is a failed login, not a server error
+@pytest.mark.parametrize('stored', ['pbkdf2_sha256$abc$salt$digest', 'scrypt$3$salt$digest'])
+def test_malformed_hash_fails_login(app, stored):
+    add_user(backend.Students, 'student', 'Student')
+    with backend.app.app_context():
+        backend.Users.query.filter_by(username='student').update({'password': stored})
+        backend.db.session.commit()
+
+    response = post_login('student')
+    assert response.status_code == 200
+    assert b'Invalid username or password' in response.data
@@ -0,0 +1,38 @@
+import pytest
+from sqlalchemy import event
+
+import backend
+from conftest import add_classes, add_user, enroll, login
+
+
+def count_queries(client, url):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    backend.catalog_cache.clear()
+    with backend.app.app_context():
+        engine = backend.db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    assert response.status_code == 200
+    return len(statements)
+
+
+# the schedule pages run the same number of statements whether the user has one class or fifty
+@pytest.mark.parametrize('username, url', [('student', '/user/classes'), ('teacher', '/teacher')])
+def test_schedule_query_count_is_independent_of_class_count(app, username, url):
+    teacher_id = add_user(backend.Teachers, 'teacher', 'Teacher')
+    student_id = add_user(backend.Students, 'student', 'Student')
+    enroll(student_id, add_classes(teacher_id, 1))
+    client = login(username)
+    few = count_queries(client, url)
+
+    enroll(student_id, add_classes(teacher_id, 49, first=1))
+    many = count_queries(client, url)
+    assert few == many
+    assert many <= 2